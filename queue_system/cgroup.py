@@ -0,0 +1,214 @@
+import os
+import time
+import signal
+
+
+# memory.stat 中不能被内核直接丢弃的内存，memory.current 还包括搜索时流式读取数据库产生的页缓存
+UNRECLAIMABLE_STAT_KEYS = ('anon', 'kernel', 'sock')
+# 5.18 之前的内核没有 kernel 项，由以下各项相加
+KERNEL_STAT_KEYS = ('kernel_stack', 'pagetables', 'percpu', 'slab_unreclaimable')
+
+
+class CgroupManager:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(CgroupManager, cls).__new__(cls)
+            cls._instance._initialize()
+        return cls._instance
+
+    def __init__(self):
+        # 单例实例只允许初始化一次，再次实例化时报错
+        if getattr(self, '_constructed', False):
+            raise Exception("This class is a singleton! Use the 'cgroup_manager' instance.")
+        self._constructed = True
+
+    def _initialize(self):
+        self.enabled = False
+        self.root = None
+        self.memory_max_ratio = None
+        self.memory_high_ratio = None
+        self.controllers = []
+
+    def setup(self, args):
+        """在委派给队列系统的 cgroup v2 子树下为每个任务创建叶子 cgroup，不可用时退回到进程树方式"""
+        if not args.get('use_cgroup', False):
+            print("未启用 cgroup，使用进程树统计和控制任务")
+            return
+
+        self.root = args.get('cgroup_root') or '/sys/fs/cgroup/rfaa-queue'
+        self.memory_max_ratio = args.get('cgroup_memory_max_ratio')
+        self.memory_high_ratio = args.get('cgroup_memory_high_ratio')
+
+        if not os.path.exists('/sys/fs/cgroup/cgroup.controllers'):
+            print("系统未挂载 cgroup v2，使用进程树统计和控制任务")
+            return
+
+        try:
+            # cgroup v2 要求开启子树控制器的节点内没有进程，调度器自身移入单独的叶子节点
+            scheduler_cgroup = os.path.join(self.root, 'scheduler')
+            os.makedirs(scheduler_cgroup, exist_ok=True)
+            self.write(scheduler_cgroup, 'cgroup.procs', os.getpid())
+
+            available = self.read(self.root, 'cgroup.controllers').split()
+            controllers = [c for c in ('memory', 'io', 'cpu', 'cpuset') if c in available]
+            if 'memory' not in controllers:
+                raise OSError(f"memory controller is not delegated to {self.root}")
+            self.write(self.root, 'cgroup.subtree_control', ' '.join(f"+{c}" for c in controllers))
+        except OSError as e:
+            print(f"无法在 {self.root} 下创建 cgroup: {e}，使用进程树统计和控制任务")
+            return
+
+        self.controllers = controllers
+        self.enabled = True
+        print(f"启用 cgroup v2: {self.root}, 控制器: {controllers}")
+
+    @staticmethod
+    def read(path, name):
+        with open(os.path.join(path, name), 'r') as file:
+            return file.read().strip()
+
+    @staticmethod
+    def write(path, name, value):
+        with open(os.path.join(path, name), 'w') as file:
+            file.write(str(value))
+
+    def create(self, task_element):
+        """为任务创建叶子 cgroup 并按预分配内存设置上限，返回 cgroup 路径"""
+        if not self.enabled:
+            return None
+        # 被杀死重新调度的任务可能还有未回收的旧 cgroup，名称中加入时间戳避免冲突
+        path = os.path.join(self.root, f"task_{task_element.id}_{int(time.time() * 1000)}")
+        try:
+            os.makedirs(path)
+            self.set_memory_limit(path, task_element.mem)
+            if task_element.cpus and 'cpuset' in self.controllers:
+                self.set_cpuset(path, task_element.cpus, task_element.numa_node)
+        except OSError as e:
+            print(f"任务 {task_element.id} 创建 cgroup 失败: {e}")
+            return None
+        return path
+
+    def set_memory_limit(self, path, mem):
+        """按预分配内存(GB)设置 memory.high 和 memory.max，比例为空时不限制"""
+        for name, ratio in (('memory.high', self.memory_high_ratio), ('memory.max', self.memory_max_ratio)):
+            value = 'max' if ratio is None or mem is None else int(mem * ratio * 1024 ** 3)
+            self.write(path, name, value)
+
+    def set_cpuset(self, path, cpus, numa_node):
+        """将任务限制在绑定的核上，绑定单个 NUMA 节点时内存也只从该节点分配"""
+        self.write(path, 'cpuset.cpus', ','.join(str(cpu) for cpu in cpus))
+        if numa_node is not None:
+            self.write(path, 'cpuset.mems', numa_node)
+
+    def reclaim(self, path):
+        """冻结后的任务不再分配内存，通过 memory.reclaim 将其内存换出到 swap/zram，返回回收的匿名内存(GB)"""
+        before = self.memory_current(path)
+        if before is None:
+            return 0
+        try:
+            # 页缓存先于匿名内存被回收，按包括页缓存在内的全部占用请求回收
+            self.write(path, 'memory.reclaim', self.read(path, 'memory.current'))
+        except OSError as e:
+            # 无法全部回收时内核返回 EAGAIN，已回收的部分仍然有效
+            print(f"回收 cgroup {path} 的内存未完成: {e}")
+        after = self.memory_current(path)
+        reclaimed = before - after if after is not None else 0
+        print(f"Reclaimed {reclaimed:.2f}GB from cgroup {path}")
+        return max(0, reclaimed)
+
+    def attach(self, path):
+        """在子进程中调用，将当前进程加入任务 cgroup，之后启动的程序都会继承"""
+        try:
+            self.write(path, 'cgroup.procs', os.getpid())
+        except OSError as e:
+            print(f"加入 cgroup {path} 失败: {e}")
+
+    def memory_current(self, path):
+        """任务当前的匿名和内核内存占用(GB)，不计可被内核丢弃的页缓存
+        memory.current 和 memory.peak 包括数据库的页缓存，会使每个搜索任务都显得超出预分配"""
+        try:
+            stat = {}
+            for line in self.read(path, 'memory.stat').splitlines():
+                key, _, value = line.partition(' ')
+                stat[key] = int(value)
+        except (OSError, ValueError):
+            return None
+        if 'kernel' not in stat:
+            stat['kernel'] = sum(stat.get(key, 0) for key in KERNEL_STAT_KEYS)
+        return sum(stat.get(key, 0) for key in UNRECLAIMABLE_STAT_KEYS) / (1024 ** 3)
+
+    def io_counters(self, path):
+        """任务累计 (读字节数, 写字节数)"""
+        read_bytes, write_bytes = 0, 0
+        try:
+            for line in self.read(path, 'io.stat').splitlines():
+                for field in line.split()[1:]:
+                    key, _, value = field.partition('=')
+                    if key == 'rbytes':
+                        read_bytes += int(value)
+                    elif key == 'wbytes':
+                        write_bytes += int(value)
+        except (OSError, ValueError):
+            pass
+        return read_bytes, write_bytes
+
+    def cpu_usage(self, path):
+        """任务累计 CPU 时间(秒)"""
+        try:
+            for line in self.read(path, 'cpu.stat').splitlines():
+                key, _, value = line.partition(' ')
+                if key == 'usage_usec':
+                    return int(value) / 1e6
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def oom_killed(self, path):
+        """检查 cgroup 内是否有进程因超过 memory.max 被杀死"""
+        try:
+            for line in self.read(path, 'memory.events').splitlines():
+                key, _, value = line.partition(' ')
+                if key == 'oom_kill':
+                    return int(value) > 0
+        except (OSError, ValueError):
+            pass
+        return False
+
+    def freeze(self, path):
+        self.write(path, 'cgroup.freeze', 1)
+        print(f"Froze cgroup {path}")
+
+    def thaw(self, path):
+        self.write(path, 'cgroup.freeze', 0)
+        print(f"Thawed cgroup {path}")
+
+    def kill(self, path):
+        """原子地杀死 cgroup 内所有进程，内核不支持 cgroup.kill 时先冻结再逐个发送信号"""
+        try:
+            self.write(path, 'cgroup.kill', 1)
+        except OSError:
+            self.freeze(path)
+            for pid in self.read(path, 'cgroup.procs').split():
+                try:
+                    os.kill(int(pid), signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            self.thaw(path)
+        print(f"Killed cgroup {path}")
+
+    def remove(self, path):
+        """任务进程全部退出后删除 cgroup"""
+        if not path:
+            return
+        try:
+            os.rmdir(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"删除 cgroup {path} 失败: {e}")
+
+
+# 单例实例
+cgroup_manager = CgroupManager()
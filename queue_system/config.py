@@ -8,8 +8,10 @@ class Config:
         return cls._instance
     
     def __init__(self):
-        if Config._instance is not None:
+        # 单例实例只允许初始化一次，再次实例化时报错
+        if getattr(self, '_constructed', False):
             raise Exception("This class is a singleton! Use the 'global_config' instance.")
+        self._constructed = True
     
     def set_args(self, args):
         self.args = args
@@ -0,0 +1,119 @@
+import os
+import glob
+
+
+def parse_cpulist(cpulist):
+    """解析 /sys 中的 CPU 列表，例如 '0-3,8-11'"""
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus):
+    return ','.join(str(cpu) for cpu in sorted(cpus))
+
+
+class CpuTopology:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(CpuTopology, cls).__new__(cls)
+            cls._instance._initialize()
+        return cls._instance
+
+    def __init__(self):
+        # 单例实例只允许初始化一次，再次实例化时报错
+        if getattr(self, '_constructed', False):
+            raise Exception("This class is a singleton! Use the 'cpu_topology' instance.")
+        self._constructed = True
+
+    def _initialize(self):
+        self.enabled = False
+        self.nodes = {}  # NUMA 节点 -> 该节点上可分配的核
+        self.free = {}  # NUMA 节点 -> 空闲核集合
+        self.db_nodes = {}  # 数据库路径 -> 最近一次使用该数据库的任务所在节点，其页缓存大概率在该节点内存中
+
+    def setup(self, args, total_core):
+        """读取 NUMA 拓扑，从当前进程可用的核中划出 total_core 个供任务绑定，第一个核留给调度器
+        返回可分配给任务的核数，亲和性受限（例如容器中）时少于 total_core"""
+        if not args.get('cpu_pinning', False):
+            print("未启用核绑定，任务由内核调度")
+            return total_core
+
+        allowed = sorted(os.sched_getaffinity(0))
+        node_of_cpu = {}
+        for node_path in glob.glob('/sys/devices/system/node/node[0-9]*'):
+            node = int(os.path.basename(node_path)[4:])
+            with open(os.path.join(node_path, 'cpulist'), 'r') as file:
+                for cpu in parse_cpulist(file.read()):
+                    node_of_cpu[cpu] = node
+
+        # 调度器保留第一个核，其余按节点均匀地划出 total_core 个核
+        candidates = allowed[1:] if len(allowed) > 1 else allowed
+        by_node = {}
+        for cpu in candidates:
+            by_node.setdefault(node_of_cpu.get(cpu, 0), []).append(cpu)
+        selected = []
+        while len(selected) < total_core and any(by_node.values()):
+            for cpus in by_node.values():
+                if cpus and len(selected) < total_core:
+                    selected.append(cpus.pop(0))
+
+        for cpu in selected:
+            self.nodes.setdefault(node_of_cpu.get(cpu, 0), set()).add(cpu)
+        self.free = {node: set(cpus) for node, cpus in self.nodes.items()}
+        self.enabled = True
+        for node, cpus in sorted(self.nodes.items()):
+            print(f"NUMA 节点 {node}: 可分配核 {format_cpulist(cpus)}")
+        return len(selected)
+
+    def assign(self, task_element, database=None):
+        """为任务分配 task_element.core 个具体的核，尽量位于同一节点，并优先选择数据库页缓存所在的节点"""
+        if not self.enabled:
+            return
+        need = task_element.core
+        preferred = self.db_nodes.get(database) if database else None
+
+        # 能装下的节点中优先选择数据库所在节点，其次选择空闲核最少的节点以减少碎片
+        fit_nodes = [node for node, cpus in self.free.items() if len(cpus) >= need]
+        if preferred in fit_nodes:
+            nodes = [preferred]
+        elif fit_nodes:
+            nodes = [min(fit_nodes, key=lambda node: (len(self.free[node]), node))]
+        else:
+            # 没有单个节点能装下，跨节点分配，从空闲核最多的节点开始
+            nodes = sorted(self.free, key=lambda node: -len(self.free[node]))
+
+        cpus = []
+        for node in nodes:
+            while self.free[node] and len(cpus) < need:
+                cpus.append(min(self.free[node]))
+                self.free[node].discard(cpus[-1])
+        task_element.cpus = sorted(cpus)
+        task_element.numa_node = nodes[0] if len(nodes) == 1 else None
+        if database and task_element.numa_node is not None:
+            self.db_nodes[database] = task_element.numa_node
+        print(f"任务 {task_element.id} 绑定核 {format_cpulist(task_element.cpus)}, NUMA 节点: {task_element.numa_node}")
+
+    def release(self, task_element):
+        """任务结束后归还其绑定的核"""
+        if not self.enabled or not task_element.cpus:
+            return
+        for cpu in task_element.cpus:
+            for node, cpus in self.nodes.items():
+                if cpu in cpus:
+                    self.free[node].add(cpu)
+        task_element.cpus = None
+        task_element.numa_node = None
+
+
+# 单例实例
+cpu_topology = CpuTopology()
@@ -0,0 +1,123 @@
+import heapq
+
+
+class IndexedHeap:
+    """按任务 id 索引的小根堆，元素按任务优先级排序，支持 O(log n) 的删除和调整优先级"""
+
+    def __init__(self):
+        self.heap = []  # 堆数组，元素为任务
+        self.index = {}  # 任务 id -> 堆数组下标
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __bool__(self):
+        return bool(self.heap)
+
+    def __contains__(self, task_element):
+        return task_element.id in self.index
+
+    def __iter__(self):
+        """按堆数组顺序遍历（不保证有序），遍历期间不能修改堆"""
+        return iter(list(self.heap))
+
+    def get(self, task_id):
+        """按 id 查找任务，不存在时返回 None"""
+        position = self.index.get(task_id)
+        return None if position is None else self.heap[position]
+
+    def push(self, task_element):
+        """加入任务，已在堆中的任务按新的优先级调整位置"""
+        if task_element.id in self.index:
+            self.update(task_element)
+            return
+        self.heap.append(task_element)
+        self.index[task_element.id] = len(self.heap) - 1
+        self.sift_up(len(self.heap) - 1)
+
+    def peek(self):
+        """返回优先级最高的任务，堆为空时返回 None"""
+        return self.heap[0] if self.heap else None
+
+    def pop(self):
+        """取出优先级最高的任务，堆为空时返回 None"""
+        if not self.heap:
+            return None
+        return self.remove_at(0)
+
+    def remove(self, task_element):
+        """按 id 删除任务，返回堆中的任务，不存在时返回 None"""
+        position = self.index.get(task_element.id)
+        if position is None:
+            return None
+        return self.remove_at(position)
+
+    def update(self, task_element):
+        """任务优先级变化后调整其位置（升高或降低均可），堆中保存的任务替换为传入的任务"""
+        position = self.index.get(task_element.id)
+        if position is None:
+            return
+        self.heap[position] = task_element
+        self.sift_up(position)
+        self.sift_down(self.index[task_element.id])
+
+    def move_to(self, task_element, other):
+        """将任务从当前堆移入另一个堆"""
+        self.remove(task_element)
+        other.push(task_element)
+
+    def nsmallest(self, n):
+        """按优先级返回前 n 个任务，只访问堆顶附近的 O(n) 个节点，复杂度 O(n log n)"""
+        result = []
+        if n <= 0 or not self.heap:
+            return result
+        # 候选堆中保存 (任务, 下标)，每取出一个节点就将其两个子节点加入候选
+        frontier = [(self.heap[0], 0)]
+        while frontier and len(result) < n:
+            task_element, position = heapq.heappop(frontier)
+            result.append(task_element)
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(self.heap):
+                    heapq.heappush(frontier, (self.heap[child], child))
+        return result
+
+    def ordered(self):
+        """按优先级从高到低返回全部任务"""
+        return sorted(self.heap)
+
+    def remove_at(self, position):
+        task_element = self.heap[position]
+        last = self.heap.pop()
+        del self.index[task_element.id]
+        if position < len(self.heap):
+            # 用末尾元素填补空位后向上或向下调整
+            self.heap[position] = last
+            self.index[last.id] = position
+            self.sift_up(position)
+            self.sift_down(self.index[last.id])
+        return task_element
+
+    def swap(self, i, j):
+        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+        self.index[self.heap[i].id] = i
+        self.index[self.heap[j].id] = j
+
+    def sift_up(self, position):
+        while position > 0:
+            parent = (position - 1) // 2
+            if not self.heap[position] < self.heap[parent]:
+                break
+            self.swap(position, parent)
+            position = parent
+
+    def sift_down(self, position):
+        size = len(self.heap)
+        while True:
+            smallest = position
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < size and self.heap[child] < self.heap[smallest]:
+                    smallest = child
+            if smallest == position:
+                break
+            self.swap(position, smallest)
+            position = smallest
@@ -0,0 +1,157 @@
+import os
+import time
+import glob
+import mmap
+import ctypes
+import threading
+
+from queue_system.telemetry import thread_log
+
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+# 逐段映射数据库文件检查驻留情况，避免一次映射数百GB
+WINDOW_SIZE = 1024 ** 3
+# 常驻页缓存的热点文件：cs219 预过滤库和各索引文件
+HOT_SUFFIXES = ('_cs219.ffdata', '_cs219.ffindex', '_a3m.ffindex', '_hhm.ffindex')
+# mincore 结果每字节最低位表示该页是否驻留
+RESIDENT_TABLE = bytes(b & 1 for b in range(256))
+
+libc = ctypes.CDLL(None, use_errno=True)
+libc.mmap.restype = ctypes.c_void_p
+libc.mmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long)
+libc.munmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+libc.mincore.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte))
+libc.mlock.argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+
+def map_file(fd, offset, length):
+    address = libc.mmap(None, length, mmap.PROT_READ, mmap.MAP_SHARED, fd, offset)
+    if address == MAP_FAILED:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return address
+
+
+def get_resident_bytes(file_path):
+    """通过 mincore 统计文件在页缓存中驻留的字节数，返回 (驻留字节数, 文件大小)"""
+    size = os.path.getsize(file_path)
+    resident_pages = 0
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        for offset in range(0, size, WINDOW_SIZE):
+            length = min(WINDOW_SIZE, size - offset)
+            pages = (length + PAGE_SIZE - 1) // PAGE_SIZE
+            address = map_file(fd, offset, length)
+            try:
+                vec = (ctypes.c_ubyte * pages)()
+                if libc.mincore(address, length, vec) != 0:
+                    errno = ctypes.get_errno()
+                    raise OSError(errno, os.strerror(errno))
+                resident_pages += bytes(vec).translate(RESIDENT_TABLE).count(1)
+            finally:
+                libc.munmap(address, length)
+    finally:
+        os.close(fd)
+    return min(size, resident_pages * PAGE_SIZE), size
+
+
+def get_database_files(database):
+    """返回数据库前缀对应的所有 ffindex/ffdata 文件"""
+    return sorted(glob.glob(f"{database}_*.ff*"))
+
+
+class PageCache:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(PageCache, cls).__new__(cls)
+            cls._instance._initialize()
+        return cls._instance
+
+    def __init__(self):
+        # 单例实例只允许初始化一次，再次实例化时报错
+        if getattr(self, '_constructed', False):
+            raise Exception("This class is a singleton! Use the 'page_cache' instance.")
+        self._constructed = True
+
+    def _initialize(self):
+        self.databases = []
+        self.residency = {}  # 数据库前缀 -> 页缓存中驻留的比例，由后台线程整体替换，调度器只读取
+        self.interval = 60
+        self.thread = None
+        self.pinned = []  # 已锁定的 (文件路径, 映射地址, 长度)
+        self.pinned_bytes = 0
+
+    def setup(self, databases):
+        self.databases = [database for database in databases if database]
+
+    def start(self, interval):
+        """启动后台统计线程，逐页检查数百GB的数据库文件较慢，不能在调度循环中进行"""
+        self.interval = interval
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name="page-cache-residency", daemon=True)
+        self.thread.start()
+        print(f"启动页缓存驻留统计线程, 统计间隔: {interval}s")
+
+    def run(self):
+        while True:
+            start_time = time.time()
+            try:
+                self.refresh()
+            except Exception as e:
+                thread_log(f"页缓存驻留统计失败: {e}")
+            time.sleep(max(0, self.interval - (time.time() - start_time)))
+
+    def refresh(self):
+        """重新统计每个数据库在页缓存中驻留的比例，统计完成后整体替换"""
+        residency = {}
+        for database in self.databases:
+            resident_total, size_total = 0, 0
+            for file_path in get_database_files(database):
+                try:
+                    resident, size = get_resident_bytes(file_path)
+                except OSError as e:
+                    thread_log(f"无法统计 {file_path} 的页缓存驻留情况: {e}")
+                    continue
+                resident_total += resident
+                size_total += size
+            residency[database] = resident_total / size_total if size_total else 0.0
+        self.residency = residency
+
+    def get_residency(self, database):
+        return self.residency.get(database, 0.0)
+
+    def pin(self, budget):
+        """在预算(GB)内将各数据库的热点文件映射并锁定在内存中，返回锁定的内存(GB)"""
+        budget_bytes = int(budget * 1024 ** 3)
+        for database in self.databases:
+            for suffix in HOT_SUFFIXES:
+                file_path = f"{database}{suffix}"
+                if not os.path.exists(file_path):
+                    continue
+                size = os.path.getsize(file_path)
+                if size == 0 or self.pinned_bytes + size > budget_bytes:
+                    print(f"{file_path} 超出锁定预算，不锁定")
+                    continue
+                fd = os.open(file_path, os.O_RDONLY)
+                try:
+                    address = map_file(fd, 0, size)
+                finally:
+                    # 映射建立后可以关闭文件描述符
+                    os.close(fd)
+                if libc.mlock(address, size) != 0:
+                    errno = ctypes.get_errno()
+                    print(f"锁定 {file_path} 失败: {os.strerror(errno)}，请检查 RLIMIT_MEMLOCK")
+                    libc.munmap(address, size)
+                    continue
+                self.pinned.append((file_path, address, size))
+                self.pinned_bytes += size
+                print(f"锁定 {file_path} ({size / 1024 ** 3:.2f}GB) 在内存中")
+        return self.pinned_bytes / 1024 ** 3
+
+
+# 单例实例
+page_cache = PageCache()
@@ -0,0 +1,212 @@
+from queue_system.config import global_config
+from queue_system.task_element import TaskElement
+
+
+# 未配置 priority_weights 的步骤在 weighted 策略下使用的权重
+DEFAULT_PRIORITY_WEIGHTS = {"time": 0.5, "mem": 0.2, "len": 0.3}
+
+
+class Pipeline:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(Pipeline, cls).__new__(cls)
+            cls._instance._initialize()
+        return cls._instance
+
+    def __init__(self):
+        # 单例实例只允许初始化一次，再次实例化时报错
+        if getattr(self, '_constructed', False):
+            raise Exception("This class is a singleton! Use the 'pipeline' instance.")
+        self._constructed = True
+
+    def _initialize(self):
+        self.loaded = False
+        self.nodes = {}  # 步骤 -> 配置中的节点
+        self.chain_root = {}  # 步骤 -> 所在条件链的第一个步骤，条件边 on_insufficient 连接的步骤属于同一条链，过滤步骤属于引用它的链
+        self.successors = {}  # 链首步骤 -> 依赖它的链首步骤
+        self.jobs = {}  # 输出目录 -> 该蛋白的流程状态: 已完成和已开始的链、合并后的参数、MSA 统计、是否失败
+
+    def load(self):
+        """从配置文件读取流程图并检查: 依赖只能指向链首步骤，条件边和过滤步骤的目标不能再有依赖，图中不能有环"""
+        nodes = global_config.get_args().get('pipeline') or {}
+        self.nodes = {step: dict(node or {}) for step, node in nodes.items()}
+        self.chain_root = {}
+        for step, node in self.nodes.items():
+            target = node.get('on_insufficient')
+            if target is None:
+                continue
+            if target not in self.nodes:
+                raise ValueError(f"Invalid on_insufficient of step {step}: {target}")
+            if self.nodes[target].get('after'):
+                raise ValueError(f"Step {target} is the target of a conditional edge and cannot have its own dependencies")
+        filters = {}
+        for step, node in self.nodes.items():
+            target = node.get('filter')
+            if target is None:
+                continue
+            if target not in self.nodes or self.nodes[target].get('after') or self.nodes[target].get('on_insufficient'):
+                raise ValueError(f"Invalid filter of step {step}: {target}")
+            filters.setdefault(target, step)
+        targets = {node.get('on_insufficient') for node in self.nodes.values()}
+        for step in self.nodes:
+            if step in targets or step in filters:
+                continue
+            for chain_step in self.follow_chain(step):
+                self.chain_root[chain_step] = step
+        for target, step in filters.items():
+            self.chain_root[target] = self.chain_root[step]
+
+        self.successors = {root: [] for root in dict.fromkeys(self.chain_root.values())}
+        for step, node in self.nodes.items():
+            for dependency in node.get('after') or []:
+                if dependency not in self.successors:
+                    raise ValueError(f"Invalid dependency of step {step}: {dependency}")
+                self.successors[dependency].append(step)
+
+        # 按依赖关系拓扑排序检查环
+        visited, visiting = set(), set()
+
+        def visit(root):
+            if root in visiting:
+                raise ValueError(f"Pipeline has a cycle through step {root}")
+            if root in visited:
+                return
+            visiting.add(root)
+            for successor in self.successors[root]:
+                visit(successor)
+            visiting.discard(root)
+            visited.add(root)
+
+        for root in self.successors:
+            visit(root)
+        self.loaded = True
+
+    def follow_chain(self, step):
+        chain = []
+        while step is not None and step not in chain:
+            chain.append(step)
+            step = self.nodes[step].get('on_insufficient')
+        return chain
+
+    def get_node(self, step):
+        if not self.loaded:
+            self.load()
+        if step not in self.nodes:
+            raise ValueError(f"Invalid step: {step}")
+        return self.nodes[step]
+
+    def has_step(self, step):
+        if not self.loaded:
+            self.load()
+        return step in self.nodes
+
+    def get_runner(self, step):
+        return self.get_node(step).get('run', step)
+
+    def get_e_value(self, step):
+        return self.get_node(step).get('e_value')
+
+    def get_next(self, step):
+        """条件边: 当前步骤的结果不满足阈值时继续运行的步骤，没有时返回 None"""
+        return self.get_node(step).get('on_insufficient')
+
+    def get_filter(self, step):
+        """搜索步骤之后单独调度的过滤步骤，没有时在搜索任务中直接过滤"""
+        return self.get_node(step).get('filter')
+
+    def get_chain(self, step):
+        """返回 step 所在条件链的全部步骤"""
+        self.get_node(step)
+        return self.follow_chain(self.chain_root[step])
+
+    def get_priority_weights(self, step):
+        return self.get_node(step).get('priority_weights') or DEFAULT_PRIORITY_WEIGHTS
+
+    def get_remaining_time(self, step, estimate):
+        """当前步骤及其后续步骤的预计时间，并行的分支取最长者，条件链按当前步骤即满足阈值计算"""
+        self.get_node(step)
+
+        def downstream(root):
+            return max((estimate(successor) + downstream(successor) for successor in self.successors[root]), default=0)
+
+        return estimate(step) + downstream(self.chain_root[step])
+
+    def make_task(self, step, seq_length, params, msa_stats=None):
+        params = dict(params)
+        # 每条链从查询序列开始，hhblits 阶梯在链内部修改 fasta_file
+        # signalp6 完成后，之后开始的链使用去除信号肽的序列，并按其长度估计资源和优先级
+        params['fasta_file'] = params.get('trimmed_fasta', params['query_fasta'])
+        seq_length = params.get('trimmed_len', seq_length)
+        if self.get_e_value(step) is not None:
+            params['e_value'] = self.get_e_value(step)
+        task_element = TaskElement(step, seq_length, params)
+        task_element.msa_stats = msa_stats
+        return task_element
+
+    def start(self, params, seq_length):
+        """为一个蛋白开始流程，返回所有没有依赖的步骤的任务，这些任务可以同时运行"""
+        if not self.loaded:
+            self.load()
+        params = dict(params)
+        params.setdefault('query_fasta', params['fasta_file'])
+        roots = [root for root in self.successors if not self.nodes[root].get('after')]
+        self.jobs[params['job_output_path']] = {
+            "done": set(),
+            "started": set(roots),
+            "params": params,
+            "msa_stats": None,
+            "failed": False,
+        }
+        return [self.make_task(root, seq_length, params) for root in roots]
+
+    def complete(self, task_element, finished_step):
+        """finished_step 所在的链已完成，返回依赖已全部满足的步骤的新任务，以及该蛋白的流程是否全部完成"""
+        job = self.jobs.get(task_element.params['job_output_path'])
+        if job is None:
+            return [], False
+        if finished_step is not None:
+            job['done'].add(self.chain_root[finished_step])
+        if job['failed']:
+            # 失败的蛋白不再分派后续步骤，最后一条运行中的链结束后删除记录
+            self.release(task_element.params['job_output_path'])
+            return [], False
+        job['params'].update(task_element.params)
+        if task_element.msa_stats:
+            job['msa_stats'] = task_element.msa_stats
+
+        new_tasks = []
+        for root in self.successors:
+            if root in job['started']:
+                continue
+            if all(dependency in job['done'] for dependency in self.nodes[root].get('after') or []):
+                job['started'].add(root)
+                new_tasks.append(self.make_task(root, task_element.len, job['params'], job['msa_stats']))
+
+        finished = len(job['done']) == len(self.successors)
+        if finished:
+            del self.jobs[task_element.params['job_output_path']]
+        return new_tasks, finished
+
+    def fail(self, task_element, failed_step):
+        """蛋白的 failed_step 所在的链失败，之后完成的其他链不再分派后续步骤，只有第一次失败返回 True"""
+        job = self.jobs.get(task_element.params['job_output_path'])
+        if job is None:
+            return False
+        first = not job['failed']
+        job['failed'] = True
+        # 失败的链不会再完成，与完成的链一样计为已结束
+        job['done'].add(self.chain_root[failed_step])
+        self.release(task_element.params['job_output_path'])
+        return first
+
+    def release(self, job_output_path):
+        """已开始的链全部结束后删除失败蛋白的记录"""
+        job = self.jobs[job_output_path]
+        if job['started'] <= job['done']:
+            del self.jobs[job_output_path]
+
+
+# 单例实例
+pipeline = Pipeline()
@@ -1,4 +1,13 @@
-import multiprocessing
+import os
+import pickle
+import struct
+from collections import deque
+from multiprocessing.connection import wait
+
+
+# 每条消息前的长度头
+HEADER = struct.Struct('!I')
+
 
 class QueueFinished:
     _instance = None
@@ -10,26 +19,90 @@ class QueueFinished:
         return cls._instance
 
     def __init__(self):
-        if QueueFinished._instance is not None:
+        # 单例实例只允许初始化一次，再次实例化时报错
+        if getattr(self, '_constructed', False):
             raise Exception("This class is a singleton! Use the 'queue_finished' instance.")
+        self._constructed = True
 
     def _initialize(self):
-        self.manager = multiprocessing.Manager()
-        self.finished = self.manager.Queue()
-        self.lock = self.manager.Lock()
+        # 每个子进程一个单向完成通道，子进程之间不共享写端也不需要锁，被杀死或挂起的子进程不会阻塞其他子进程上报
+        self.readers = {}  # 子进程 pid -> 非阻塞读端 fd，只在调度器进程中使用
+        self.buffers = {}  # 子进程 pid -> 尚未组成完整消息的字节
+        self.messages = deque()  # 已读出的完整消息
+        self.writer = None  # 子进程中自己的写端 fd
+
+    def open_channel(self):
+        """启动子进程前创建其完成通道，返回 (读端, 写端)"""
+        reader, writer = os.pipe()
+        os.set_blocking(reader, False)
+        return reader, writer
+
+    def attach(self, writer):
+        """子进程启动后使用自己的写端上报"""
+        self.writer = writer
+
+    def add_channel(self, pid, reader, writer):
+        """子进程启动后调度器关闭写端，只保留读端，子进程退出后读端读到 EOF"""
+        os.close(writer)
+        self.readers[pid] = reader
+        self.buffers[pid] = b''
+
+    def report(self, event, task_element):
+        """子进程上报任务事件: started / finished / failed"""
+        data = pickle.dumps((event, os.getpid(), task_element))
+        data = HEADER.pack(len(data)) + data
+        while data:
+            data = data[os.write(self.writer, data):]
 
     def add_task(self, task_element):
-        with self.lock:
-            print(f"任务 {task_element.params["job_name"]} 已完成 {task_element.step} 步骤并加入完成队列")
-            self.finished.put(task_element)
+        """子进程完成当前步骤，task_element 中已写入下一步骤（流程结束时为 None）"""
+        print(f"任务 {task_element.params['job_name']} 已完成当前步骤并上报调度器, 下一步骤: {task_element.step}")
+        self.report('finished', task_element)
+
+    def fetch(self):
+        """非阻塞地读出所有通道中的数据并拆分出完整的消息，调度器不会因写到一半被挂起的子进程阻塞，读到 EOF 的通道关闭"""
+        for pid, reader in list(self.readers.items()):
+            closed = False
+            while True:
+                try:
+                    chunk = os.read(reader, 65536)
+                except BlockingIOError:
+                    break
+                if not chunk:
+                    closed = True
+                    break
+                self.buffers[pid] += chunk
+            buffer = self.buffers[pid]
+            while len(buffer) >= HEADER.size:
+                size = HEADER.unpack_from(buffer)[0]
+                if len(buffer) < HEADER.size + size:
+                    break
+                self.messages.append(pickle.loads(buffer[HEADER.size:HEADER.size + size]))
+                buffer = buffer[HEADER.size + size:]
+            self.buffers[pid] = buffer
+            if closed:
+                # 写到一半被杀死的子进程留下的不完整消息直接丢弃
+                os.close(reader)
+                del self.readers[pid]
+                del self.buffers[pid]
 
     def get_task(self):
-        with self.lock:
-            return self.finished.get()
-        
+        """调度器读取一条消息，返回 (事件, 子进程 pid, 任务)"""
+        if not self.messages:
+            self.fetch()
+        return self.messages.popleft()
+
     def is_empty(self):
-        with self.lock:
-            return self.finished.empty()
-        
+        if not self.messages:
+            self.fetch()
+        return not self.messages
+
+    def wait(self, sentinels, timeout):
+        """阻塞直到有子进程退出、通道中有新消息或超时"""
+        if self.messages:
+            return []
+        return wait(list(sentinels) + list(self.readers.values()), timeout)
+
+
 # 单例实例
-queue_finished = QueueFinished()
\ No newline at end of file
+queue_finished = QueueFinished()
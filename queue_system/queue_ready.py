@@ -1,6 +1,7 @@
 # multi_level_priority_queue.py
-import multiprocessing
 from scripts.calculate_priority import calculate_priority
+from queue_system.indexed_heap import IndexedHeap
+from queue_system.pipeline import pipeline
 
 class MultiLevelPriorityQueue:
     _instance = None
@@ -12,46 +13,65 @@ class MultiLevelPriorityQueue:
         return cls._instance
 
     def __init__(self):
-        if MultiLevelPriorityQueue._instance is not None:
+        # 单例实例只允许初始化一次，再次实例化时报错
+        if getattr(self, '_constructed', False):
             raise Exception("This class is a singleton! Use the 'queue_ready' instance.")
+        self._constructed = True
 
     def _initialize(self):
-        self.manager = multiprocessing.Manager()
-        self.queues = {
-            "hhsearch": self.manager.PriorityQueue(),
-            "psipred": self.manager.PriorityQueue(),
-            "signalp6": self.manager.PriorityQueue(),
-            "hhblits_bfd": self.manager.PriorityQueue(),
-            "hhblits_uniref_3": self.manager.PriorityQueue(),
-            "hhblits_uniref_2": self.manager.PriorityQueue(),
-            "hhblits_uniref_1": self.manager.PriorityQueue(),
-        }
-        self.lock = self.manager.Lock()
+        # 就绪队列只由调度器进程访问，每个步骤一个按任务 id 索引的小根堆，步骤来自配置中的流程图，第一次入队时创建
+        self.queues = {}
 
     def add_task(self, task_element):
         print(f"Adding task to ready queue: \n{task_element}")
         step = task_element.step
-        if step not in self.queues:
+        if not pipeline.has_step(step):
             raise ValueError(f"Invalid step: {step}")
+        # 先记录入队时间，优先级计算需要用到
+        task_element.update_time()
         task_element.priority = calculate_priority(step, task_element)
-        with self.lock:
-            print(f"Adding task to {step} queue: \n{task_element}")
-            task_element.update_time()
-            self.queues[step].put(task_element)
+        print(f"Adding task to {step} queue: \n{task_element}")
+        self.queues.setdefault(step, IndexedHeap()).push(task_element)
+
+    def remove_task(self, task_element):
+        """按 id 从所在的步骤队列中移除任务，返回被移除的任务，不在就绪队列中时返回 None"""
+        for queue in self.queues.values():
+            if task_element in queue:
+                return queue.remove(task_element)
+        return None
 
     def get_task(self):
-        with self.lock:
-            for step in self.queues:
-                if self.queues[step].empty():
-                    continue
-                return step, self.queues[step].get()
+        for step in self.queues:
+            if not self.queues[step]:
+                continue
+            return step, self.queues[step].pop()
         return None, None
     
+    def get_fit_task(self, select, depth=1):
+        """取每个步骤队列的前 depth 个候选任务，由 select 选出一个任务出队，其余留在原队列"""
+        candidates = {step: queue.nsmallest(depth) for step, queue in self.queues.items()}
+
+        task_element = select(candidates)
+        if task_element is not None:
+            self.queues[task_element.step].remove(task_element)
+        return task_element
+
+    def get_batch(self, step, size, depth, accept):
+        """按优先级检查步骤队列的前 depth 个任务，取出最多 size 个 accept 返回 True 的任务"""
+        batch = []
+        queue = self.queues.get(step, IndexedHeap())
+        for task_element in queue.nsmallest(depth):
+            if len(batch) >= size:
+                break
+            if accept(task_element):
+                queue.remove(task_element)
+                batch.append(task_element)
+        return batch
+
     def is_empty(self):
-        with self.lock:
-            for step in self.queues:
-                if not self.queues[step].empty():
-                    return False
+        for step in self.queues:
+            if self.queues[step]:
+                return False
         return True
 
 # 单例实例
@@ -1,55 +1,108 @@
-import multiprocessing
 import psutil
-import time
 import os
+import math
+import time
 import signal
 from scripts.calculate_priority import calculate_priority
 from scripts.run_task import run_task
-from queue_system.queue_ready import queue_ready
-from queue_system.queue_finished import queue_finished
+from queue_system.cgroup import cgroup_manager
+from queue_system.indexed_heap import IndexedHeap
+from queue_system.telemetry import telemetry_sampler
+from scripts.utilities import get_intermediate_a3m
+
+# 选择被杀死任务时内存的离散化单位(GB)
+KILL_MEM_UNIT = 0.1
 
 class QueueRunning:
     def __init__(self):
-        self.manager = multiprocessing.Manager()
-        self.lock = self.manager.Lock()
-        self.normal = self.manager.PriorityQueue()  # 正常运行任务
-        self.excess = self.manager.PriorityQueue()  # 超限运行任务
-        self.suspend = self.manager.PriorityQueue() # 暂时挂起任务
+        # 运行队列只由调度器进程访问，使用按任务 id 索引的小根堆，移除和迁移任务为 O(log n)
+        self.normal = IndexedHeap()  # 正常运行任务
+        self.excess = IndexedHeap()  # 超限运行任务
+        self.suspend = IndexedHeap() # 暂时挂起任务
+
+        self.tasks = {}  # 任务 id -> 运行中的任务
+        self.processes = {}  # 子进程 pid -> (任务 id, 子进程对象, cgroup 路径)，子进程被回收前一直保留
+        self.batch_members = {}  # 批量任务中尚未上报完成的成员 id -> 批量任务 id
 
     # 将任务添加到正常队列，并执行任务
     def add_to_normal(self, task_element):
         print(f"任务 {task_element.id} 加入normal队列")
+        task_element.peak_mem = None
+        # 为任务创建独立的 cgroup，子进程启动后先加入其中
+        task_element.cgroup = cgroup_manager.create(task_element)
+        # 先执行任务，使加入队列的任务带有 pid
+        process = run_task(task_element)
+        self.processes[process.pid] = (task_element.id, process, task_element.cgroup)
+        self.tasks[task_element.id] = task_element
+        for member in task_element.params.get('batch_tasks', []):
+            self.batch_members[member.id] = task_element.id
+        telemetry_sampler.track(task_element)
+        task_element.update_time()
         task_element.priority = calculate_priority('normal', task_element)
-        with self.lock:
-            task_element.update_time()
-            self.normal.put(task_element)
-        # 执行任务
-        run_task(task_element)
+        self.normal.push(task_element)
+
+    def get_sentinels(self):
+        """返回所有未回收子进程的 sentinel，供调度器等待子进程退出"""
+        return [process.sentinel for _, process, _ in self.processes.values()]
+
+    def get_task(self, task_id, pid=None):
+        """按 id 查找运行中的任务，指定 pid 时只返回由该进程运行的任务"""
+        task_element = self.tasks.get(task_id)
+        if task_element is None or (pid is not None and task_element.pid != pid):
+            return None
+        return task_element
+
+    def get_batch_member(self, task_id, pid=None):
+        """按 id 查找运行中批量任务里尚未完成的成员，指定 pid 时只返回由该进程运行的成员"""
+        batch_task = self.get_task(self.batch_members.get(task_id), pid)
+        if batch_task is None:
+            return None
+        for member in batch_task.params['batch_tasks']:
+            if member.id == task_id:
+                return member
+        return None
+
+    def finish_batch_member(self, member):
+        self.batch_members.pop(member.id, None)
+
+    def pop_batch_members(self, task_element):
+        """返回批量任务中尚未上报完成的成员并移除记录，普通任务返回空列表"""
+        members = []
+        for member in task_element.params.get('batch_tasks', []):
+            if self.batch_members.pop(member.id, None) is not None:
+                members.append(member)
+        return members
+
+    def reap_exited_processes(self):
+        """回收已退出的子进程，返回 [(子进程 pid, 任务 id, exitcode, 是否因超过内存上限被杀死, cgroup 路径), ...]
+        cgroup 由调度器处理完任务后删除，以便读取其内存峰值"""
+        exited = []
+        for pid, (task_id, process, cgroup_path) in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del self.processes[pid]
+            oom_killed = cgroup_manager.oom_killed(cgroup_path) if cgroup_path else False
+            exited.append((pid, task_id, process.exitcode, oom_killed, cgroup_path))
+        return exited
 
     def remove_task(self, queue, task_element):
-        with self.lock:
-            temp_queue = []
-            while not queue.empty():
-                element = queue.get()
-                if element != task_element:
-                    temp_queue.append(element)
-            for element in temp_queue:
-                queue.put(element)
+        queue.remove(task_element)
 
     def move_to_excess(self, task_element):
+        # 先移出原队列再修改优先级，避免堆中的任务顺序失效
+        if task_element in self.normal:
+            self.remove_task(self.normal, task_element)
+            print(f"任务 {task_element.id} 从正常队列移出")
         task_element.priority = calculate_priority('excess', task_element)
         print(f"任务 {task_element.id} 移入超限队列, 优先级: {task_element.priority}")
-        with self.lock:
-            if task_element in self.normal:
-                self.remove_task(self.normal, task_element)
-                print(f"任务 {task_element.id} 从正常队列移出")
-            task_element.update_time()
-            self.excess.append(task_element)
-            print(f"任务 {task_element.id} 移入超限队列成功")
+        task_element.update_time()
+        self.excess.push(task_element)
+        print(f"任务 {task_element.id} 移入超限队列成功")
 
     def is_excess(self, task_element):
         # 检查任务实时占用内存是否超过预设值
-        if task_element.mem < self.get_task_memory_usage(task_element.pid):
+        if task_element.mem < self.get_task_memory(task_element):
             return True
         return False
 
@@ -60,90 +113,137 @@ class QueueRunning:
                 print(f"任务 {task_element.id} 超限，移入超限队列")
                 self.move_to_excess(task_element)
 
-    def suspend_task(self, task_element):
-        # 暂时挂起任务
-        self.suspend_task_process_tree(task_element.pid)
+    def suspend_task(self, task_element, reclaim=False):
+        """暂时挂起任务，reclaim 为 True 时将冻结任务的内存换出，返回换出的内存(GB)"""
+        reclaimed = 0
+        if task_element.cgroup:
+            cgroup_manager.freeze(task_element.cgroup)
+            if reclaim:
+                reclaimed = cgroup_manager.reclaim(task_element.cgroup)
+        else:
+            self.suspend_task_process_tree(task_element.pid)
+        if task_element in self.normal:
+            self.remove_task(self.normal, task_element)
+        elif task_element in self.excess:
+            self.remove_task(self.excess, task_element)
         task_element.priority = calculate_priority('suspend', task_element)
-        with self.lock:
-            if task_element in self.normal:
-                self.remove_task(self.normal, task_element)
-            elif task_element in self.excess:
-                self.remove_task(self.excess, task_element)
-            task_element.update_time()
-            self.suspend.append(task_element)
+        task_element.update_time()
+        self.suspend.push(task_element)
+        return reclaimed
+
+    def pop_suspended(self):
+        """取出最近挂起的任务，没有挂起任务时返回 None"""
+        return self.suspend.pop()
+
+    def get_resident_memory(self, task_element):
+        """任务当前驻留内存(GB)，挂起换出后直接读取 cgroup，不等待下一次采样"""
+        if task_element.cgroup:
+            memory_usage = cgroup_manager.memory_current(task_element.cgroup)
+            if memory_usage is not None:
+                return memory_usage
+        return self.get_task_memory(task_element)
 
     def resume_task(self, task_element):
         # 恢复挂起任务
-        with self.lock:
+        if task_element.cgroup:
+            cgroup_manager.thaw(task_element.cgroup)
+        else:
             self.resume_task_process_tree(task_element.pid)
-            task_element.priority = calculate_priority('normal', task_element)
-            task_element.update_time()
-            self.normal.append(task_element)
-
-    def kill_a_task(self):
-        with self.lock:
-            if not self.normal.empty():
-                print("normal队列不为空，取出一个任务")
-                task_element = self.normal.get()
-            elif not self.excess.empty():
-                print("normal队列为空，excess队列不为空，取出一个任务")
-                task_element = self.excess.get()
-            elif not self.suspend.empty():
-                print("normal队列、excess队列为空，suspend队列不为空，取出一个任务")
-                task_element = self.suspend.get()
-            else:
-                print("所有队列为空，无任务可取")
-                return
-            
-            # 杀死任务
-            self.kill_task_process_tree(task_element.pid)
+        task_element.priority = calculate_priority('normal', task_element)
+        task_element.update_time()
+        self.normal.push(task_element)
+
+    def get_lost_work(self, task_element, a3m_discount):
+        """估计杀死任务损失的 CPU 时间(秒)，hhblits 搜索结果已写出的任务重新运行时会跳过搜索，按折扣计算
+        推测执行的分支被杀死后主线仍会运行该步骤，不计损失"""
+        if task_element.params.get('speculative'):
+            return 0.0
+        cpu_time = telemetry_sampler.cpu_time(task_element.id)
+        if cpu_time is None:
+            cpu_time = max(0, time.time() - task_element.time) * task_element.core
+        a3m_file = get_intermediate_a3m(task_element)
+        if a3m_file and os.path.exists(a3m_file):
+            cpu_time *= a3m_discount
+        return cpu_time
 
-            # 加入完成队列回收资源
-            queue_finished.add_task(task_element)
+    def select_victims(self, deficit, a3m_discount):
+        """选出回收内存不少于 deficit(GB) 且损失 CPU 时间最少的一组任务（最小代价覆盖的背包问题）
+        所有任务都杀死也不够时返回全部可回收内存的任务"""
+        candidates = []
+        for task_element in list(self.normal) + list(self.excess) + list(self.suspend):
+            reclaim = self.get_task_memory(task_element)
+            if reclaim <= 0:
+                continue
+            candidates.append((task_element, reclaim, self.get_lost_work(task_element, a3m_discount)))
+        if not candidates:
+            return []
+        if sum(reclaim for _, reclaim, _ in candidates) < deficit:
+            print(f"所有任务的内存占用之和不足 {deficit:.2f}GB，全部杀死")
+            return [task_element for task_element, _, _ in candidates]
 
-            # 放回就绪队列等待调度
-            queue_ready.add_task(task_element)
+        # cost[j]: 回收至少 j 个单位内存的最小损失，超过缺口的部分按缺口计
+        target = max(1, math.ceil(deficit / KILL_MEM_UNIT - 1e-9))
+        cost = [0.0] + [float('inf')] * target
+        choice = [[] for _ in range(target + 1)]
+        for task_element, reclaim, lost_work in candidates:
+            units = max(1, int(reclaim / KILL_MEM_UNIT + 1e-9))
+            # 逆序遍历保证每个任务最多选一次
+            for j in range(target, 0, -1):
+                previous = max(0, j - units)
+                if cost[previous] + lost_work < cost[j]:
+                    cost[j] = cost[previous] + lost_work
+                    choice[j] = choice[previous] + [task_element]
+        return choice[target]
 
+    def kill_task(self, task_element):
+        """杀死运行中的任务并移出运行队列，返回运行中的任务，由调度器回收资源并重新调度"""
+        print(f"杀死任务 {task_element.id}, 步骤: {task_element.step}, 内存占用: {self.get_task_memory(task_element):.2f}GB")
+        # 杀死任务，子进程退出后由 reap_exited_processes 回收
+        if task_element.cgroup:
+            cgroup_manager.kill(task_element.cgroup)
+        else:
+            self.kill_task_process_tree(task_element.pid)
+        return self.finish_task(task_element)
 
     def finish_task(self, task_element):
-        # 任务结束，移出运行队列
-        with self.lock:
-            if task_element in self.normal:
-                self.remove_task(self.normal, task_element)
-            elif task_element in self.excess:
-                self.remove_task(self.excess, task_element)
-            elif task_element in self.suspend:
-                self.remove_task(self.suspend, task_element)
-            queue_finished.add_task(task_element)
+        """任务结束，移出运行队列并记录内存峰值，返回运行中的任务"""
+        task_element = self.tasks.pop(task_element.id, task_element)
+        for queue in (self.normal, self.excess, self.suspend):
+            self.remove_task(queue, task_element)
+
+        # memory.peak 包括页缓存，内存峰值使用采样得到的匿名内存峰值
+        task_element.peak_mem = telemetry_sampler.peak(task_element.id) or None
+        telemetry_sampler.untrack(task_element.id)
+        return task_element
 
     def is_empty(self):
-        with self.lock:
-            return self.normal.empty() and self.excess.empty() and self.suspend.empty()
+        return not self.tasks
         
-    def get_task_memory_usage(pid):
-        try:
-            main_process = psutil.Process(pid)
-            processes = [main_process] + main_process.children(recursive=True)
-            print(f"process: {processes}")
-            total_memory = sum(proc.memory_info().rss for proc in processes)
-            total_memory_gb = total_memory / (1024 ** 3)
-            print(f"Process with PID {pid} uses {total_memory_gb} GB memory.")
-            return total_memory_gb
-        except psutil.NoSuchProcess:
-            print(f"Process with PID {pid} does not exist.")
-            return None
-    
+    def get_task_memory(self, task_element):
+        """从遥测采样线程读取任务最近的内存占用(GB)，不阻塞"""
+        memory_usage = telemetry_sampler.memory(task_element.id)
+        return memory_usage if memory_usage is not None else 0
+
+    @staticmethod
     def kill_task_process_tree(pid):
-        """彻底杀死指定进程及其所有子进程"""
+        """彻底杀死指定进程及其所有子进程，挂起的进程收到 SIGCONT 后才会处理 SIGTERM"""
         try:
             process = psutil.Process(pid)
-            for child in process.children(recursive=True):
+            children = process.children(recursive=True)
+            for child in children:
                 os.kill(child.pid, signal.SIGTERM)  # 终止子进程
             os.kill(pid, signal.SIGTERM)  # 终止主进程
+            # 被 SIGSTOP 挂起的任务不会退出，内存仍被占用而调度器已将其重新调度
+            for target in [child.pid for child in children] + [pid]:
+                try:
+                    os.kill(target, signal.SIGCONT)
+                except ProcessLookupError:
+                    pass
             print(f"Killed process tree with root PID {pid}")
         except psutil.NoSuchProcess:
             print(f"Process with PID {pid} does not exist.")
 
+    @staticmethod
     def suspend_task_process_tree(pid):
         """暂停指定进程及其所有子进程"""
         try:
@@ -155,6 +255,7 @@ class QueueRunning:
         except psutil.NoSuchProcess:
             print(f"Process with PID {pid} does not exist.")
 
+    @staticmethod
     def resume_task_process_tree(pid):
         """恢复指定进程及其所有子进程"""
         try:
@@ -167,81 +268,45 @@ class QueueRunning:
             print(f"Process with PID {pid} does not exist.")
 
     def get_total_memory_usage(self):
-        with self.lock:
-            total_memory = 0
-            for task_element in self.normal:
-                total_memory += self.get_task_memory_usage(task_element.pid)
-            for task_element in self.excess:
-                total_memory += self.get_task_memory_usage(task_element.pid)
-            for task_element in self.suspend:
-                total_memory += self.get_task_memory_usage(task_element.pid)
-            return total_memory
-        
-    def get_task_io_usage(task):
-        try:
-            # 获取主进程
-            main_process = psutil.Process(task.pid)
-            initial_io = 0
-            final_io = 0
-            interval = 1  # 检测时间2秒
-
-            # 计算初始的IO使用量
-            if main_process.is_running():
-                io_counters = main_process.io_counters()
-                initial_io += io_counters.read_bytes + io_counters.write_bytes
-
-            # 获取子进程的初始IO
-            for child in main_process.children(recursive=True):
-                if child.is_running():
-                    child_io = child.io_counters()
-                    initial_io += child_io.read_bytes + child_io.write_bytes
-
-            # 等待指定的时间间隔
-            time.sleep(interval)
-
-            # 计算间隔后的IO使用量
-            if main_process.is_running():
-                io_counters = main_process.io_counters()
-                final_io += io_counters.read_bytes + io_counters.write_bytes
-
-            # 获取子进程的间隔后IO
-            for child in main_process.children(recursive=True):
-                if child.is_running():
-                    child_io = child.io_counters()
-                    final_io += child_io.read_bytes + child_io.write_bytes
-
-            # 计算IO变化率
-            io_rate = (final_io - initial_io) / interval  # 每秒字节数
-            print(f"任务 {task.id} 的单位时间IO使用量: {io_rate}")
-            return io_rate
+        # 运行中的任务按预分配内存和实际占用中的较大者计算，刚启动、内存尚未增长的任务仍占用其预分配的内存
+        total_memory = 0
+        for task_element in self.normal:
+            total_memory += max(task_element.mem, self.get_task_memory(task_element))
+        for task_element in self.excess:
+            total_memory += max(task_element.mem, self.get_task_memory(task_element))
+        for task_element in self.suspend:
+            # 挂起任务的内存可能已被换出，按实际驻留内存计算，恢复前会重新检查内存
+            total_memory += self.get_resident_memory(task_element)
+        return total_memory
         
-        except psutil.NoSuchProcess:
-            print(f"任务 {task.id} 的进程 {task.pid} 不存在")
-            return 0
+    def get_task_io_usage(self, task):
+        """从遥测采样线程读取任务最近的单位时间IO使用量，不阻塞"""
+        io_rate = telemetry_sampler.io_rate(task.id)
+        print(f"任务 {task.id} 的单位时间IO使用量: {io_rate}")
+        return io_rate
 
     def get_a_high_io_task(self):
-        with self.lock:
-            # 依次遍历正常队列和超限队列并返回IO使用率最高的任务
-            high_io_task = None
-            high_io_rate = 0
-            if not self.normal.empty():
-                print("normal队列不为空, 遍历normal队列是否有高IO任务")
-                for task_element in self.normal:
-                    io_rate = self.get_task_io_usage(task_element)
-                    if io_rate > high_io_rate:
-                        high_io_rate = io_rate
-                        high_io_task = task_element
-            elif not self.excess.empty():
-                print("normal队列为空, 遍历excess队列是否有高IO任务")
-                for task_element in self.excess:
-                    io_rate = self.get_task_io_usage(task_element)
-                    if io_rate > high_io_rate:
-                        high_io_rate = io_rate
-                        high_io_task = task_element
-            else:
-                print("normal队列和excess队列均为空，无法获取高IO任务")
-                return None
-            return high_io_task
+        # 依次遍历正常队列和超限队列并返回IO使用率最高的任务
+        high_io_task = None
+        high_io_rate = 0
+        if self.normal:
+            print("normal队列不为空, 遍历normal队列是否有高IO任务")
+            for task_element in self.normal:
+                io_rate = self.get_task_io_usage(task_element)
+                if io_rate > high_io_rate:
+                    high_io_rate = io_rate
+                    high_io_task = task_element
+        elif self.excess:
+            print("normal队列为空, 遍历excess队列是否有高IO任务")
+            for task_element in self.excess:
+                io_rate = self.get_task_io_usage(task_element)
+                if io_rate > high_io_rate:
+                    high_io_rate = io_rate
+                    high_io_task = task_element
+        else:
+            print("normal队列和excess队列均为空，无法获取高IO任务")
+            return None
+        return high_io_task
 
 
 # 单例模式
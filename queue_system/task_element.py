@@ -1,7 +1,9 @@
 import time
+import uuid
 
 class TaskElement:
     def __init__(self, step, len, params):
+        self._id = uuid.uuid4().hex[:12]  # 任务唯一标识，跨进程复制后保持不变
         self._step = step  # 初始化任务步骤
         self._len = len # 初始化蛋白序列长度
         self._params = params  # 初始化受保护的任务参数
@@ -10,6 +12,16 @@ class TaskElement:
         self._core = None  # 预分配的 core 数量
         self._mem = None  # 预分配的内存数量
         self._time = None  # 初始化时间戳
+        self._peak_mem = None  # 当前步骤运行中观测到的内存峰值
+        self._cgroup = None  # 当前步骤所在的 cgroup 路径
+        self._cpus = None  # 当前步骤绑定的核
+        self._numa_node = None  # 当前步骤绑定的 NUMA 节点，跨节点时为 None
+        self._msa_stats = None  # 最近一次 hhblits 得到的 MSA 统计: 序列条数、Neff、覆盖度
+
+    @property
+    def id(self):
+        """任务唯一标识的 getter 方法"""
+        return self._id
 
     @property
     def step(self):
@@ -84,6 +96,56 @@ class TaskElement:
         """内存数量的 setter 方法"""
         self._mem = value
 
+    @property
+    def peak_mem(self):
+        """内存峰值的 getter 方法"""
+        return self._peak_mem
+
+    @peak_mem.setter
+    def peak_mem(self, value):
+        """内存峰值的 setter 方法"""
+        self._peak_mem = value
+
+    @property
+    def cgroup(self):
+        """cgroup 路径的 getter 方法"""
+        return self._cgroup
+
+    @cgroup.setter
+    def cgroup(self, value):
+        """cgroup 路径的 setter 方法"""
+        self._cgroup = value
+
+    @property
+    def cpus(self):
+        """绑定核的 getter 方法"""
+        return self._cpus
+
+    @cpus.setter
+    def cpus(self, value):
+        """绑定核的 setter 方法"""
+        self._cpus = value
+
+    @property
+    def numa_node(self):
+        """NUMA 节点的 getter 方法"""
+        return self._numa_node
+
+    @numa_node.setter
+    def numa_node(self, value):
+        """NUMA 节点的 setter 方法"""
+        self._numa_node = value
+
+    @property
+    def msa_stats(self):
+        """MSA 统计的 getter 方法"""
+        return self._msa_stats
+
+    @msa_stats.setter
+    def msa_stats(self, value):
+        """MSA 统计的 setter 方法"""
+        self._msa_stats = value
+
     @property
     def time(self):
         """时间戳的 getter 方法"""
@@ -102,7 +164,16 @@ class TaskElement:
 
     # 重写 __repr__ 方法，用于打印任务信息 
     def __repr__(self):
-        return f"TaskElement(step={self.step}, len={self.len}, priority={self.priority}, pid={self.pid}, core={self.core}, mem={self.mem}, time={self.time})"
+        return f"TaskElement(id={self.id}, step={self.step}, len={self.len}, priority={self.priority}, pid={self.pid}, core={self.core}, mem={self.mem}, time={self.time})"
+
+    # 重写 __eq__ 和 __hash__ 方法，任务经过进程间传递后仍可按 id 识别
+    def __eq__(self, other):
+        if not isinstance(other, TaskElement):
+            return NotImplemented
+        return self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
 
     # 重写 __lt__ 方法，用于加入优先级队列时比较任务优先级
     def __lt__(self, other):
@@ -1,14 +1,25 @@
-import multiprocessing
+import os
 import psutil
 import time
 from queue_system.queue_ready import queue_ready
 from queue_system.queue_running import queue_running
 from queue_system.queue_finished import queue_finished
+from queue_system.cgroup import cgroup_manager
+from queue_system.telemetry import telemetry_sampler
+from queue_system.cpu_topology import cpu_topology
+from queue_system.page_cache import page_cache
+from queue_system.pipeline import pipeline
 from queue_system.config import global_config
+from queue_system.task_element import TaskElement
+from scripts.memory_model import memory_model
+from scripts.runtime_model import runtime_model
+from scripts.rung_model import rung_model, get_sequence_features, get_signalp_result
+from scripts.utilities import get_job_mem_num, get_job_core_num, get_memory_key, get_step_database, get_next_rung, get_rung_index, get_ladder
+from scripts import msa_hhblits_batch, msa_signalp6_batch
 
 class TaskScheduler:
     def __init__(self):
-        self.lock = multiprocessing.Manager().Lock()  # 进程间锁
+        # 队列只在调度器进程内访问，子进程只通过 queue_finished 的完成通道上报事件，不再需要进程间锁
 
         # 固定值，表示设定的资源总量
         self.total_avaliable_core = None
@@ -22,6 +33,34 @@ class TaskScheduler:
         self.mem_buffer = None
         self.wait_time_max = None
         self.wait_time_mid = None
+        self.telemetry_interval = None
+        self.allocate_policy = None
+        self.backfill_depth = None
+        self.reserve_wait_time = None
+        self.kill_a3m_discount = None
+        self.suspend_reclaim = None
+        self.db_batch_size = None
+        self.db_residency_interval = None
+        self.pinned_cache_mem = 0
+        self.hhblits_batch_size = None
+        self.signalp6_batch_size = None
+        self.speculative_ladder = False
+        self.output_path = None
+
+        # 当前批次调度的数据库及已分配的任务数，同一数据库的任务成批调度以减少页缓存抖动
+        self.batch_database = None
+        self.batch_count = 0
+
+        # 最近一次选择任务时为饿死的队首任务预留的内存，合并批量任务时同样不能占用
+        self.reserved_mem = 0
+
+        # 上一次采样的CPU时间，用于非阻塞地计算IO等待率
+        self.last_cpu_times = None
+
+        # e-value 阶梯的推测执行，均以任务输出目录区分不同的蛋白
+        self.branches = {}  # 输出目录 -> {步骤: 运行中的推测分支}
+        self.speculated = {}  # 输出目录 -> 已推测执行过的步骤，不重复推测
+        self.parked = {}  # 输出目录 -> 等待同一步骤推测分支结束的主线任务
 
     def initialize(self):
         print("初始化监控系统参数")
@@ -41,26 +80,74 @@ class TaskScheduler:
         print(f"剩余运行内存量: {available_memory:.2f} GB")
 
         # 设置全局参数
-        user_set_total_avaliable_core = args.total_avaliable_core
-        user_set_total_avaliable_mem = args.total_avaliable_mem
-        self.mem_buffer = args.mem_buffer
-        self.wait_time_max = args.wait_time_max
-        self.wait_time_mid = args.wait_time_mid
+        user_set_total_avaliable_core = args['total_avaliable_core']
+        user_set_total_avaliable_mem = args['total_avaliable_mem']
+        self.mem_buffer = args['mem_buffer']
+        self.wait_time_max = args['wait_time_max']
+        self.wait_time_mid = args['wait_time_mid']
+        self.telemetry_interval = args.get('telemetry_interval', 5)
+        self.allocate_policy = args.get('allocate_policy', 'best_fit')
+        self.backfill_depth = args.get('backfill_depth', 8)
+        self.reserve_wait_time = args.get('reserve_wait_time', 300)
+        self.kill_a3m_discount = args.get('kill_a3m_discount', 0.1)
+        self.suspend_reclaim = args.get('suspend_reclaim', False)
+        self.db_batch_size = args.get('db_batch_size', 0)
+        self.db_residency_interval = args.get('db_residency_interval', 60)
+        self.hhblits_batch_size = args.get('hhblits_batch_size', 1)
+        self.signalp6_batch_size = args.get('signalp6_batch_size', 1)
+        self.speculative_ladder = args.get('speculative_ladder', False)
+        self.output_path = args['output_path']
+
+        # auto 表示使用检测到的全部资源
+        if user_set_total_avaliable_core == 'auto':
+            user_set_total_avaliable_core = core_count
+        if user_set_total_avaliable_mem == 'auto':
+            user_set_total_avaliable_mem = available_memory
 
         self.total_avaliable_core = user_set_total_avaliable_core if user_set_total_avaliable_core <= core_count else core_count
         self.total_avaliable_mem = user_set_total_avaliable_mem if user_set_total_avaliable_mem <= available_memory else available_memory
         
         self.total_avaliable_core = self.total_avaliable_core - 1  # 为监控进程预留一个核
-        self.total_avaliable_mem = self.total_avaliable_mem - args.mem_buffer  # 减去内存缓冲区
+        self.total_avaliable_mem = self.total_avaliable_mem - self.mem_buffer  # 减去内存缓冲区
+
+        # 在预算内将数据库热点文件锁定在页缓存中，锁定的内存与内存缓冲区一起从总内存中扣除
+        page_cache.setup([args.get('db_uniref_path'), args.get('db_bfd_path'), args.get('db_pdb_path')])
+        if args.get('db_pin_budget'):
+            self.pinned_cache_mem = page_cache.pin(args['db_pin_budget'])
+            self.total_avaliable_mem = self.total_avaliable_mem - self.pinned_cache_mem
+
+        # 为每个任务创建独立 cgroup 进行统计和控制
+        cgroup_manager.setup(args)
+
+        # 读取 NUMA 拓扑，为任务分配具体的核
+        # psutil.cpu_count() 统计全部逻辑核，当前进程的亲和性只允许其中一部分时按实际可绑定的核数调度
+        pinned_core = cpu_topology.setup(args, self.total_avaliable_core)
+        if pinned_core < self.total_avaliable_core:
+            print(f"当前进程的亲和性只允许绑定 {pinned_core} 个核，可分配核数由 {self.total_avaliable_core} 调整为 {pinned_core}")
+            self.total_avaliable_core = pinned_core
 
         self.current_avaliable_core = self.total_avaliable_core
         self.current_avaliable_mem = self.total_avaliable_mem
 
+        # 启动后台遥测采样线程
+        telemetry_sampler.start(args.get('telemetry_sample_interval', 1), args.get('telemetry_ring_size', 60))
+
+        # 后台定期统计各数据库在页缓存中的驻留比例，用于选择下一批调度的数据库
+        if self.db_batch_size:
+            page_cache.start(self.db_residency_interval)
+
         # 打印最终设置的参数
         print(f"最终总资源设置: core: {self.total_avaliable_core}核, memory: {self.total_avaliable_mem}GB")
-        print(f"内存缓冲区: {self.mem_buffer}GB")
+        print(f"内存缓冲区: {self.mem_buffer}GB, 锁定的数据库页缓存: {self.pinned_cache_mem:.2f}GB")
         print(f"CPU最大等待率: {self.wait_time_max}%")
         print(f"CPU中等等待率: {self.wait_time_mid}%")
+        print(f"遥测间隔: {self.telemetry_interval}s")
+        print(f"分配策略: {self.allocate_policy}, 回填深度: {self.backfill_depth}, 预留等待时间: {self.reserve_wait_time}s")
+        print(f"已有a3m任务的损失折扣: {self.kill_a3m_discount}")
+        print(f"挂起任务时换出内存: {self.suspend_reclaim}")
+        print(f"同一数据库成批调度的任务数: {self.db_batch_size}, 页缓存驻留统计间隔: {self.db_residency_interval}s")
+        print(f"hhblits 批量运行的查询数: {self.hhblits_batch_size}, signalp6 批量运行的序列数: {self.signalp6_batch_size}")
+        print(f"e-value 阶梯推测执行: {self.speculative_ladder}")
 
 
     def monitor(self):
@@ -76,6 +163,11 @@ class TaskScheduler:
         # 连续尝试调入任务的次数
         allocate_try_times = 0
 
+        # 下一次遥测（超限检查、内存、IO）的时间
+        next_telemetry_time = time.time()
+        # 上一轮是否成功分配了任务
+        allocated = False
+
         # 监控系统初始化完成，启动监控资源状态
         print("监控系统初始化完成，开始监控资源状态")
         while True:
@@ -89,129 +181,532 @@ class TaskScheduler:
                     if allocate_try_times > 10:
                         print("运行队列为空，就绪队列不为空，连续尝试次数过多，退出")
                         break
-            
-            # 检查是否有任务超限
-            print("检查运行队列是否有任务超限")
-            queue_running.check_excess_and_move()
-
-
-            # 检查内存资源状态并更新
-            print("检查内存资源状态")
-            memory_left = self.check_memory_left()
-            if memory_left < 0:
-                # 内存资源不足，尝试杀死任务
-                print("内存资源不足，尝试杀死任务")
-                memory_left = self.killer(memory_left)
-                if memory_left < 0:
-                    print("尝试杀死任务后内存资源仍不足，退出")
-                    break
-            print("成功杀死任务，memory_left: ", memory_left)
-            self.current_avaliable_mem = memory_left
 
-            # 检查IO资源状态
-            print("检查IO资源状态")
-            wa = self.check_high_io_usage()
-            print(f"当前IO等待率: {wa:.2f}%")
-            self.suspender(wa)
+            # 等待事件：子进程退出、完成通道有新消息，或遥测定时器到期
+            # 上一轮成功分配了任务时不等待，继续尝试分配剩余资源
+            timeout = 0 if allocated else max(0, next_telemetry_time - time.time())
+            queue_finished.wait(queue_running.get_sentinels(), timeout)
 
-            # 检查是否有任务完成并回收预分配的CPU资源
+            # 处理子进程上报的事件，回收已完成任务的资源
             if not queue_finished.is_empty():
                 self.collector()
 
+            # 回收已退出的子进程，未上报完成就退出的任务按异常处理
+            self.reaper()
+
+            # 遥测定时器到期，检查内存和IO资源状态
+            if time.time() >= next_telemetry_time:
+                if not self.telemetry():
+                    break
+                memory_model.save()
+                runtime_model.save()
+                rung_model.save()
+                next_telemetry_time = time.time() + self.telemetry_interval
+
             # 尝试分配任务
-            if self.check_sufficient_resources():
-                print("资源剩余量大于0，尝试分配任务")
-                if self.allocator():
-                    allocate_try_times = 0
-                else:
-                    allocate_try_times += 1
+            allocated = False
+            if not queue_ready.is_empty():
+                allocated = self.check_sufficient_resources() and self.allocator()
+                # 资源不足或没有能装入的任务都计为一次失败的尝试
+                allocate_try_times = 0 if allocated else allocate_try_times + 1
+
+            # 就绪队列为空时用空闲资源提前运行 e-value 阶梯的后续步骤
+            if self.speculative_ladder and queue_ready.is_empty() and self.check_sufficient_resources():
+                self.speculate()
+
+        # 保存资源模型供下次运行使用
+        memory_model.save()
+        runtime_model.save()
+        rung_model.save()
+
+    # 遥测：超限检查、内存回收和IO挂起，返回 False 表示内存不足无法继续
+    def telemetry(self):
+        # 检查是否有任务超限
+        print("检查运行队列是否有任务超限")
+        queue_running.check_excess_and_move()
+
+        # 检查内存资源状态并更新
+        print("检查内存资源状态")
+        memory_left = self.check_memory_left()
+        if memory_left < 0:
+            # 内存资源不足，尝试杀死任务
+            print("内存资源不足，尝试杀死任务")
+            memory_left = self.killer(memory_left)
+            if memory_left < 0:
+                print("尝试杀死任务后内存资源仍不足，退出")
+                return False
+            print("成功杀死任务，memory_left: ", memory_left)
+        self.current_avaliable_mem = memory_left
 
-    # 从queue_finished中回收任务资源
+        # 检查IO资源状态
+        print("检查IO资源状态")
+        wa = self.check_high_io_usage()
+        print(f"当前IO等待率: {wa:.2f}%")
+        self.suspender(wa)
+        return True
+
+    # 从queue_finished中读取子进程上报的事件并回收任务资源
     def collector(self):
-        with self.lock:
-            while not queue_finished.is_empty():
-                task_element = queue_finished.get_task()
-                print(f"任务 {task_element.id} 已完成，回收cpu资源: {task_element.cpu}")
-                # 回收预分配的CPU资源，这里不计算内存资源，因为内存资源变动快，需要实时更新
-                core_cost = task_element.core
-                self.current_avaliable_core += core_cost
-
-    # 从就绪队列分配任务到queue_running 的 normal 队列
+        while not queue_finished.is_empty():
+            event, pid, reported_task = queue_finished.get_task()
+            # 只处理仍在运行且由上报进程运行的任务，已被杀死的任务的迟到消息直接丢弃
+            task_element = queue_running.get_task(reported_task.id, pid)
+            if task_element is None:
+                # 批量任务的成员由批量任务的进程分别上报
+                member = queue_running.get_batch_member(reported_task.id, pid)
+                if member is not None:
+                    self.collect_member(event, member, reported_task)
+                    continue
+                print(f"任务 {reported_task.id} 不在运行队列中，忽略进程 {pid} 上报的事件: {event}")
+                continue
+
+            if event == 'started':
+                # 子进程实际开始运行的时间，用于统计运行时间
+                task_element.update_time()
+
+            elif event == 'finished':
+                queue_running.finish_task(task_element)
+                self.release_resources(task_element)
+                if task_element.params.get('batch_tasks'):
+                    # 批量任务的资源占用与单个任务不同，不记录到资源模型，未上报的成员重新调度
+                    self.requeue(task_element, no_batch=True)
+                    continue
+                # 记录内存峰值和运行时间用于更新资源模型
+                # 过滤任务的内存按 a3m 大小估计，不使用按序列长度分区间的内存模型，记录的观测值不会被读取
+                if pipeline.get_runner(task_element.step) != 'hhblits_filter':
+                    memory_model.record(get_memory_key(task_element), task_element.len, task_element.peak_mem)
+                runtime_model.record(task_element.step, task_element.len, time.time() - task_element.time)
+                finished_step = self.get_finished_step(task_element)
+                self.record_rung(reported_task, finished_step)
+                self.enqueue_next_step(reported_task, finished_step)
+
+            elif event == 'failed':
+                print(f"任务 {task_element.id} 的步骤 {task_element.step} 运行失败")
+                queue_running.finish_task(task_element)
+                self.release_resources(task_element)
+                if task_element.params.get('batch_tasks'):
+                    # 批量运行失败，未完成的成员单独重新调度
+                    self.requeue(task_element, no_batch=True)
+                else:
+                    self.promote_waiter(task_element)
+
+    def collect_member(self, event, member, reported_task):
+        # 处理批量任务中单个成员上报的事件，成员不单独占用资源
+        if event == 'finished':
+            queue_running.finish_batch_member(member)
+            self.record_rung(reported_task, member.step)
+            self.enqueue_next_step(reported_task, member.step)
+        elif event == 'failed':
+            print(f"批量任务成员 {member.id} 的步骤 {member.step} 运行失败，单独重新调度")
+            queue_running.finish_batch_member(member)
+            member.params['no_batch'] = True
+            queue_ready.add_task(member)
+
+    def enqueue_next_step(self, reported_task, finished_step=None):
+        # finished_step 为刚完成的步骤，新建或重新放回的任务为 None
+        # 推测分支搜索结束后继续过滤，之后不继续流程，只检查是否已提交结果
+        if reported_task.params.get('speculative'):
+            if reported_task.step is None:
+                self.finish_branch(reported_task)
+                return
+        elif get_rung_index(reported_task.step) >= 0 and not reported_task.params.get('batch_tasks'):
+            self.route_rung(reported_task)
+        job_output_path = reported_task.params.get('job_output_path')
+        if job_output_path in self.speculated and not reported_task.params.get('speculative'):
+            if reported_task.step is None and get_rung_index(finished_step) >= 0:
+                # 主线离开 e-value 阶梯，其余推测分支不再需要
+                self.cancel_branches(job_output_path)
+            elif reported_task.step in self.branches.get(job_output_path, {}):
+                # 下一步骤正在推测执行，等其结束: 分支提交了结果时主线结束，否则主线以自己的输入运行这一级
+                print(f"任务 {reported_task.id} 的步骤 {reported_task.step} 正在推测执行，等待其结束")
+                self.parked[job_output_path] = reported_task
+                return
+        # 子进程上报的任务已写入条件边的下一步骤，当前分支完成时为 None，由流程图分派依赖已满足的步骤
+        if reported_task.step is None:
+            new_tasks, finished = pipeline.complete(reported_task, finished_step)
+            for new_task in new_tasks:
+                print(f"任务 {reported_task.id} 完成 {finished_step}，分派步骤 {new_task.step}: 任务 {new_task.id}")
+                self.enqueue_next_step(new_task)
+            if finished:
+                print(f"{reported_task.params['job_output_path']} 所有步骤已完成")
+            return
+        reported_task.mem = get_job_mem_num(reported_task)
+        reported_task.core = get_job_core_num(reported_task)
+        reported_task.pid = None
+        reported_task.cgroup = None
+        reported_task.cpus = None
+        reported_task.numa_node = None
+        queue_ready.add_task(reported_task)
+
+    def route_rung(self, task_element):
+        # 进入 hhblits 阶梯前和每级之后，按历史结果预测该蛋白会在哪一级得到 MSA，跳过几乎必然不足阈值的级别
+        params = task_element.params
+        if params.get('rung_features') is None:
+            # 第一次进入阶梯时 fasta_file 仍是查询序列
+            params['rung_features'] = get_sequence_features(params['fasta_file']) + [get_signalp_result(params['job_output_path'])]
+        if params.get('first_nseq') is None and task_element.msa_stats:
+            params['first_nseq'] = task_element.msa_stats['nseq']
+        current = get_rung_index(task_element.step)
+        predicted = rung_model.predict(params['rung_features'], params.get('first_nseq'))
+        if predicted <= current:
+            return
+        # 从预测的级别继续，该级仍不足阈值时按原阶梯继续
+        ladder = get_ladder(task_element.step)
+        if predicted >= len(ladder):
+            return
+        task_element.step, params['e_value'] = ladder[predicted]
+        print(f"任务 {task_element.id} 预计在 {task_element.step} 得到足够的 MSA，跳过之前的级别")
+
+    def get_finished_step(self, task_element):
+        # 过滤步骤完成时，所属的阶梯步骤为其搜索步骤
+        if pipeline.get_runner(task_element.step) == 'hhblits_filter':
+            return task_element.params.get('search_step', task_element.step)
+        return task_element.step
+
+    def record_rung(self, reported_task, step):
+        # 提交了最终 MSA 的阶梯步骤，记录其级别用于预测
+        params = reported_task.params
+        if get_rung_index(step) < 0 or not params.get('committed'):
+            return
+        rung_model.record(params.get('rung_features'), params.get('first_nseq'), get_rung_index(step))
+
+    def requeue(self, task_element, no_batch=False):
+        # 将结束运行但未完成当前步骤的任务放回就绪队列，批量任务拆分为尚未完成的成员
+        if task_element.params.get('speculative'):
+            # 推测分支被杀死或异常退出后不再重新运行
+            self.finish_branch(task_element)
+            return
+        members = queue_running.pop_batch_members(task_element)
+        if not task_element.params.get('batch_tasks'):
+            queue_ready.add_task(task_element)
+            return
+        for member in members:
+            if no_batch:
+                member.params['no_batch'] = True
+            queue_ready.add_task(member)
+
+    def promote_waiter(self, task_element):
+        # 任务失败后不再运行，由第一个等待相同序列结果的输入从头开始流程，其余等待者转而等待它
+        if task_element.params.get('speculative'):
+            # 推测分支失败不影响主线
+            self.finish_branch(task_element)
+            return
+        # 同一蛋白并行的其他步骤之后完成时不再分派后续步骤，等待者只接替一次
+        if not pipeline.fail(task_element, self.get_finished_step(task_element)):
+            return
+        waiters = task_element.params.get('waiters')
+        if not waiters:
+            return
+        params = dict(waiters[0])
+        params['cache_key'] = task_element.params.get('cache_key')
+        params['waiters'] = waiters[1:]
+        for new_task in pipeline.start(params, task_element.len):
+            print(f"任务 {task_element.id} 失败，由等待者 {params['job_name']} 的任务 {new_task.id} 重新运行步骤 {new_task.step}")
+            self.enqueue_next_step(new_task)
+
+    def speculate(self):
+        """节点空闲时，为运行在 e-value 阶梯上的主线任务提前运行下一级搜索，每个蛋白每级最多推测一次"""
+        for task_element in list(queue_running.tasks.values()):
+            params = task_element.params
+            if params.get('speculative') or params.get('batch_tasks') or get_rung_index(task_element.step) < 0:
+                continue
+            job_output_path = params['job_output_path']
+            if os.path.exists(os.path.join(job_output_path, "t000_.msa0.a3m")):
+                continue
+            # 从主线和已推测过的步骤中最靠后的一级继续推测
+            branches = self.branches.setdefault(job_output_path, {})
+            speculated = self.speculated.setdefault(job_output_path, set())
+            step = max([task_element.step] + list(speculated), key=get_rung_index)
+            rung = get_next_rung(step)
+            if rung is None:
+                continue
+
+            branch_params = dict(params)
+            # 推测分支与主线当前步骤使用相同的输入，只提交结果不继续流程，也不携带等待者
+            branch_params.update(e_value=rung[1], speculative=True, committed=False, waiters=[])
+            branch = TaskElement(rung[0], task_element.len, branch_params)
+            branch.mem = get_job_mem_num(branch)
+            branch.core = get_job_core_num(branch)
+            if not self.fits(branch, 0, 0):
+                continue
+            print(f"节点空闲，为任务 {task_element.id} 推测执行步骤 {branch.step} (e-value {rung[1]})，分支任务 {branch.id}")
+            self.allocate_resources(branch)
+            cpu_topology.assign(branch, get_step_database(branch))
+            queue_running.add_to_normal(branch)
+            branches[branch.step] = branch
+            speculated.add(branch.step)
+
+    def finish_branch(self, branch):
+        # 推测分支结束，提交了结果时取消同一蛋白的其他分支，等待该分支的主线任务放回就绪队列
+        # 分支上报时步骤已置为 None，按 id 查找其推测的步骤
+        job_output_path = branch.params['job_output_path']
+        branches = self.branches.get(job_output_path, {})
+        for step, running_branch in list(branches.items()):
+            if running_branch.id == branch.id:
+                del branches[step]
+                branch.step = step
+        if branch.params.get('committed'):
+            print(f"推测分支 {branch.id} 的步骤 {branch.step} 提交了最终 MSA")
+            self.record_rung(branch, branch.step)
+            self.cancel_branches(job_output_path, main_line=True)
+            return
+        parked = self.parked.get(job_output_path)
+        if parked is not None and parked.step not in branches:
+            del self.parked[job_output_path]
+            self.enqueue_next_step(parked)
+
+    def cancel_branches(self, job_output_path, main_line=False):
+        """杀死同一蛋白仍在运行的推测分支，main_line 为 True 时主线也重新调度，其重新运行时会发现已提交的结果"""
+        for branch in list(self.branches.pop(job_output_path, {}).values()):
+            if queue_running.get_task(branch.id) is not None:
+                print(f"取消推测分支 {branch.id} 的步骤 {branch.step}")
+                self.release_resources(queue_running.kill_task(branch))
+            elif queue_ready.remove_task(branch) is not None:
+                # 搜索已结束、等待过滤的推测分支
+                print(f"取消等待过滤的推测分支 {branch.id}")
+        if main_line:
+            for task_element in list(queue_running.tasks.values()):
+                params = task_element.params
+                if params.get('job_output_path') == job_output_path and not params.get('speculative') and get_rung_index(task_element.step) >= 0:
+                    print(f"主线任务 {task_element.id} 的结果已由推测分支提交，重新调度")
+                    task_element = queue_running.kill_task(task_element)
+                    self.release_resources(task_element)
+                    queue_ready.add_task(task_element)
+        self.speculated.pop(job_output_path, None)
+        parked = self.parked.pop(job_output_path, None)
+        if parked is not None:
+            self.enqueue_next_step(parked)
+
+    # 回收已退出的子进程
+    def reaper(self):
+        exited = queue_running.reap_exited_processes()
+        if not exited:
+            return
+        # 子进程退出前上报的消息此时一定已在通道中，先处理完再判断任务是否异常退出
+        self.collector()
+
+        for pid, task_id, exitcode, oom_killed, cgroup_path in exited:
+            task_element = queue_running.get_task(task_id, pid)
+            if task_element is None:
+                cgroup_manager.remove(cgroup_path)
+                continue
+            # 子进程未能自行上报完成，由调度器代为回收资源
+            print(f"任务 {task_id} 的进程 {pid} 异常退出, exitcode: {exitcode}")
+            queue_running.finish_task(task_element)
+            self.release_resources(task_element)
+            if task_element.params.get('batch_tasks'):
+                # 批量任务异常退出，未完成的成员单独重新调度
+                self.requeue(task_element, no_batch=True)
+            elif oom_killed:
+                # 超过 memory.max 被杀死，按上限重新预分配内存后放回就绪队列
+                task_element.mem = task_element.mem * (cgroup_manager.memory_max_ratio or 2)
+                print(f"任务 {task_id} 超过内存上限被杀死，内存预分配调整为 {task_element.mem}GB 后重新调度")
+                self.requeue(task_element)
+            else:
+                self.promote_waiter(task_element)
+            cgroup_manager.remove(cgroup_path)
+
+    def release_resources(self, task_element):
+        # 回收预分配的CPU和内存资源，内存会在下一次遥测时按实际占用重新计算
+        print(f"任务 {task_element.id} 结束，回收资源: core: {task_element.core}, memory: {task_element.mem}GB")
+        self.current_avaliable_core += task_element.core
+        cpu_topology.release(task_element)
+        self.current_avaliable_mem = min(self.total_avaliable_mem, self.current_avaliable_mem + task_element.mem)
+
+    # 从就绪队列分配任务到queue_running 的 normal 队列，尽可能多地装入剩余资源
     def allocator(self):
-        with self.lock:
-            step, task_element = queue_ready.get_task()
-            if step and task_element:
-                print(f"尝试分配任务 {task_element.id} 到运行队列")
-                if not self.allocate_resources(task_element):
-                    print("任务 {task_element.id} 的资源需求超过剩余资源，无法分配")
-                    return False
-                queue_running.add_to_normal(task_element)
+        print("资源剩余量大于0，尝试分配任务")
+        allocated_count = 0
+        while self.check_sufficient_resources():
+            task_element = queue_ready.get_fit_task(self.select_task, self.backfill_depth)
+            if task_element is None:
+                break
+            task_element = self.make_batch(task_element)
+            print(f"尝试分配任务 {task_element.id} 到运行队列")
+            database = get_step_database(task_element)
+            if database:
+                self.batch_count += 1
+            self.allocate_resources(task_element)
+            cpu_topology.assign(task_element, get_step_database(task_element))
+            queue_running.add_to_normal(task_element)
+            allocated_count += 1
+
+        if allocated_count == 0:
+            print("就绪队列中没有能装入剩余资源的任务")
+        return allocated_count > 0
+
+    def select_task(self, candidates):
+        """从所有步骤队列的候选任务中选出一个可装入剩余资源的任务，没有则返回 None"""
+        now = time.time()
+        heads = [tasks[0] for tasks in candidates.values() if tasks]
+
+        # 为等待最久且装不下的队首任务预留资源，避免大任务被小任务持续回填而饿死
+        reserved_task = None
+        for task_element in heads:
+            if self.fits(task_element, 0, 0):
+                continue
+            if task_element.core > self.total_avaliable_core or task_element.mem > self.total_avaliable_mem:
+                print(f"任务 {task_element.id} 的资源需求超过资源总量，不为其预留资源")
+                continue
+            if now - task_element.time < self.reserve_wait_time:
+                continue
+            if reserved_task is None or task_element.time < reserved_task.time:
+                reserved_task = task_element
+
+        reserved_core, reserved_mem = 0, 0
+        if reserved_task is not None:
+            reserved_core, reserved_mem = reserved_task.core, reserved_task.mem
+            print(f"为任务 {reserved_task.id} 预留资源: core: {reserved_core}, memory: {reserved_mem}GB")
+        self.reserved_mem = reserved_mem
+
+        # 在预留之外的剩余资源中回填其他任务
+        fit_tasks = []
+        for tasks in candidates.values():
+            for task_element in tasks:
+                if task_element is not reserved_task and self.fits(task_element, reserved_core, reserved_mem):
+                    fit_tasks.append(task_element)
+        if not fit_tasks:
+            return None
+        fit_tasks = self.select_batch(fit_tasks)
+
+        if self.allocate_policy == 'first_fit':
+            # 按优先级选择第一个能装下的任务
+            return min(fit_tasks)
+
+        # best_fit: 选择分配后剩余资源（按总量归一化）最少的任务，同等情况下优先级高的先分配
+        def leftover(task_element):
+            core_left = (self.current_avaliable_core - reserved_core - task_element.core) / self.total_avaliable_core
+            mem_left = (self.current_avaliable_mem - reserved_mem - task_element.mem) / self.total_avaliable_mem
+            return core_left + mem_left, task_element.priority
+
+        return min(fit_tasks, key=leftover)
+
+    def make_batch(self, task_element):
+        """从同一步骤的就绪队列中再取出最多 batch_size - 1 个任务，与选中的任务合并为一次 hhblits_omp 或 signalp6 运行"""
+        if pipeline.get_runner(task_element.step) == 'signalp6':
+            batch_module, batch_size = msa_signalp6_batch, self.signalp6_batch_size
+        else:
+            batch_module, batch_size = msa_hhblits_batch, self.hhblits_batch_size
+        if batch_size <= 1 or not batch_module.is_batchable(task_element):
+            return task_element
+        members = [task_element]
+
+        def accept(candidate):
+            if not batch_module.is_batchable(candidate):
+                return False
+            # 与 select_task 相同地扣除为队首任务预留的内存，批量任务的核数与选中的任务相同
+            if batch_module.get_batch_mem(members + [candidate], task_element.core) > self.current_avaliable_mem - self.reserved_mem:
+                return False
+            members.append(candidate)
+            return True
 
-        return True
+        queue_ready.get_batch(task_element.step, batch_size - 1, max(self.backfill_depth, batch_size), accept)
+        if len(members) == 1:
+            return task_element
+        return batch_module.make_batch_task(members, self.output_path)
+
+    def select_batch(self, fit_tasks):
+        """同一时间只调度一个数据库的搜索任务，不搜索数据库的任务不受限制"""
+        if not self.db_batch_size:
+            return fit_tasks
+        databases = {get_step_database(task_element) for task_element in fit_tasks} - {None}
+        if not databases:
+            return fit_tasks
+
+        # 当前批次数据库没有可装入的任务或批次已满时，切换到页缓存驻留比例最高的数据库
+        if self.batch_database not in databases or self.batch_count >= self.db_batch_size:
+            others = databases - {self.batch_database} or databases
+            database = max(others, key=page_cache.get_residency)
+            if database != self.batch_database:
+                print(f"切换调度批次数据库: {self.batch_database} -> {database}, 页缓存驻留比例: {page_cache.get_residency(database):.2%}")
+            self.batch_database = database
+            self.batch_count = 0
+
+        return [task_element for task_element in fit_tasks if get_step_database(task_element) in (None, self.batch_database)]
+
+    def fits(self, task_element, reserved_core, reserved_mem):
+        # 检查任务能否装入扣除预留后的剩余资源
+        return (task_element.core <= self.current_avaliable_core - reserved_core
+                and task_element.mem <= self.current_avaliable_mem - reserved_mem)
 
     # 暂时挂起任务
     def suspender(self, wa):
-        with self.lock:
-            # 如果IO等待时间超过最大等待时间，挂起任务
-            if wa >= self.wait_time_max:
-                print("IO等待时间超过最大等待时间，尝试挂起任务")
-                task_element = queue_running.get_a_high_io_task()
-                if not task_element:
-                    print("没有找到可以挂起的任务")
-                    return
-                print(f"挂起任务 {task_element.id}")
-                queue_running.suspend_task(task_element)
-
-            # 如果IO等待时间小于中等等待时间，恢复挂起的任务
-            elif wa < self.wait_time_mid:
-                print("IO等待时间小于中等等待时间，尝试恢复挂起任务")
-                if not queue_running.suspend.empty():
-                    task_element = queue_running.suspend.get()
-                    queue_running.resume_task(task_element)
-                    return
+        # 如果IO等待时间超过最大等待时间，挂起任务
+        if wa >= self.wait_time_max:
+            print("IO等待时间超过最大等待时间，尝试挂起任务")
+            task_element = queue_running.get_a_high_io_task()
+            if not task_element:
+                print("没有找到可以挂起的任务")
+                return
+            print(f"挂起任务 {task_element.id}")
+            reclaimed = queue_running.suspend_task(task_element, self.suspend_reclaim)
+            if reclaimed > 0:
+                # 挂起任务换出的内存可供其他任务使用
+                self.current_avaliable_mem = min(self.total_avaliable_mem, self.current_avaliable_mem + reclaimed)
+                print(f"挂起任务 {task_element.id} 换出内存 {reclaimed:.2f}GB, 当前可用内存: {self.current_avaliable_mem:.2f}GB")
+
+        # 如果IO等待时间小于中等等待时间，恢复挂起的任务
+        elif wa < self.wait_time_mid:
+            print("IO等待时间小于中等等待时间，尝试恢复挂起任务")
+            task_element = queue_running.suspend.peek()
+            if task_element is None:
                 print("没有挂起的任务可以恢复")
+                return
+            # 恢复前按内存模型重新检查，换出的内存换入后不能超过可用内存
+            mem_needed = max(0, self.get_resume_mem(task_element) - queue_running.get_resident_memory(task_element))
+            if mem_needed > self.current_avaliable_mem:
+                print(f"恢复任务 {task_element.id} 需要换入 {mem_needed:.2f}GB 内存, 可用内存不足，暂不恢复")
+                return
+            self.current_avaliable_mem -= mem_needed
+            queue_running.resume_task(queue_running.pop_suspended())
+
+    def get_resume_mem(self, task_element):
+        # 任务恢复后预计的内存占用：预分配内存和内存模型估计值中的较大者
+        return max(task_element.mem, get_job_mem_num(task_element))
 
 
     # 终止任务
     def killer(self, memory_left):
-        with self.lock:
-            # 一直杀死任务，直到内存资源足够
-            kill_try_times = 0
-            while True:
-                queue_running.kill_a_task()
-                memory_left = self.check_memory_left()
-                kill_try_times += 1
-                if memory_left >= 0 or kill_try_times > 10:
-                    print("杀死任务结束, memory_left: ", memory_left, "kill_try_times: ", kill_try_times)
-                    break
-            return memory_left
+        # 按回收内存和损失的计算量选择被杀死的任务，直到内存资源足够
+        kill_try_times = 0
+        while memory_left < 0 and kill_try_times < 10:
+            kill_try_times += 1
+            victims = queue_running.select_victims(-memory_left, self.kill_a3m_discount)
+            if not victims:
+                print("没有可以回收内存的任务")
+                break
+            for task_element in victims:
+                task_element = queue_running.kill_task(task_element)
+                # 回收被杀死任务的资源，并放回就绪队列等待调度
+                self.release_resources(task_element)
+                self.requeue(task_element)
+            # 被杀死的任务已移出运行队列，剩余内存按其余任务的占用重新计算
+            memory_left = self.check_memory_left()
+        print("杀死任务结束, memory_left: ", memory_left, "kill_try_times: ", kill_try_times)
+        return memory_left
 
 
     def check_memory_left(self):
         total_memory_usage = queue_running.get_total_memory_usage()
-        print(f"当前内存使用量: {total_memory_usage:.2f} GB")
+        print(f"当前内存使用量(含预分配): {total_memory_usage:.2f} GB")
         memory_left = self.total_avaliable_mem - total_memory_usage
         print(f"剩余内存: {memory_left:.2f} GB")
         
         return memory_left
 
     def check_high_io_usage(self):
-        # 记录5秒内的wa值
-        wa_values = []
-        start_time = time.time()
-        duration = 5
-        
-        while time.time() - start_time < duration:
-            # 获取IO等待时间
-            cpu_times = psutil.cpu_times_percent(interval=1)
-            wa_values.append(cpu_times.iowait)
-        
-        # 计算并返回wa的平均值
-        if wa_values:
-            avg_wa = sum(wa_values) / len(wa_values)
-            return avg_wa
-        else:
+        # 计算自上一次遥测以来的平均wa值，不阻塞等待
+        cpu_times = psutil.cpu_times()
+        last_cpu_times = self.last_cpu_times
+        self.last_cpu_times = cpu_times
+        if last_cpu_times is None:
+            return 0.0
+
+        total_delta = sum(cpu_times) - sum(last_cpu_times)
+        if total_delta <= 0:
             return 0.0
+        iowait_delta = getattr(cpu_times, 'iowait', 0.0) - getattr(last_cpu_times, 'iowait', 0.0)
+        return iowait_delta / total_delta * 100
 
     def check_sufficient_resources(self):
         # 检查内存和cpu资源是否足够
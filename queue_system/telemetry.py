@@ -0,0 +1,204 @@
+import os
+import time
+import threading
+from collections import deque
+
+from queue_system.cgroup import cgroup_manager
+
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def thread_log(message):
+    """后台线程直接写标准错误的文件描述符，不经过 sys.stdout 的缓冲区锁
+    调度器随时 fork 子进程，fork 时若后台线程持有该锁，子进程第一次 print 就会死锁"""
+    os.write(2, f"{message}\n".encode())
+
+
+def read_proc_stat(pid):
+    """读取 /proc/[pid]/stat，返回 (ppid, CPU时间秒数, RSS字节数)"""
+    with open(f"/proc/{pid}/stat", 'r') as file:
+        data = file.read()
+    # 进程名可能包含空格和括号，从最后一个右括号之后开始解析
+    fields = data[data.rindex(')') + 2:].split()
+    ppid = int(fields[1])
+    cpu_time = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    rss = int(fields[21]) * PAGE_SIZE
+    return ppid, cpu_time, rss
+
+
+def read_proc_io(pid):
+    """读取 /proc/[pid]/io，返回 (读字节数, 写字节数)，无权限时返回 (0, 0)"""
+    read_bytes, write_bytes = 0, 0
+    try:
+        with open(f"/proc/{pid}/io", 'r') as file:
+            for line in file:
+                key, _, value = line.partition(':')
+                if key == 'read_bytes':
+                    read_bytes = int(value)
+                elif key == 'write_bytes':
+                    write_bytes = int(value)
+    except (OSError, ValueError):
+        pass
+    return read_bytes, write_bytes
+
+
+class TelemetrySampler:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(TelemetrySampler, cls).__new__(cls)
+            cls._instance._initialize()
+        return cls._instance
+
+    def __init__(self):
+        # 单例实例只允许初始化一次，再次实例化时报错
+        if getattr(self, '_constructed', False):
+            raise Exception("This class is a singleton! Use the 'telemetry_sampler' instance.")
+        self._constructed = True
+
+    def _initialize(self):
+        self.lock = threading.Lock()
+        self.interval = 1
+        self.ring_size = 60
+        self.tasks = {}  # 任务 id -> (根进程 pid, cgroup 路径)
+        self.series = {}  # 任务 id -> deque[(时间, RSS(GB), CPU秒数, 读字节数, 写字节数)]
+        self.peaks = {}  # 任务 id -> 内存峰值(GB)
+        self.thread = None
+
+    def start(self, interval, ring_size):
+        """启动后台采样线程，每个间隔扫描一次 /proc"""
+        self.interval = interval
+        self.ring_size = ring_size
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name="telemetry-sampler", daemon=True)
+        self.thread.start()
+        print(f"启动遥测采样线程, 采样间隔: {interval}s, 环形缓冲区长度: {ring_size}")
+
+    def track(self, task_element):
+        with self.lock:
+            self.tasks[task_element.id] = (task_element.pid, task_element.cgroup)
+            self.series[task_element.id] = deque(maxlen=self.ring_size)
+            self.peaks[task_element.id] = 0.0
+
+    def untrack(self, task_id):
+        with self.lock:
+            self.tasks.pop(task_id, None)
+            self.series.pop(task_id, None)
+            self.peaks.pop(task_id, None)
+
+    def run(self):
+        while True:
+            start_time = time.time()
+            try:
+                self.sample()
+            except Exception as e:
+                thread_log(f"遥测采样失败: {e}")
+            time.sleep(max(0, self.interval - (time.time() - start_time)))
+
+    def sample(self):
+        """扫描一次 /proc 建立进程树，汇总每个任务的 RSS、CPU 和读写字节数"""
+        with self.lock:
+            tasks = dict(self.tasks)
+        if not tasks:
+            return
+
+        now = time.time()
+        samples = {}
+
+        # 有 cgroup 的任务直接读取 cgroup 统计
+        for task_id, (pid, cgroup_path) in tasks.items():
+            if not cgroup_path:
+                continue
+            memory = cgroup_manager.memory_current(cgroup_path)
+            cpu_time = cgroup_manager.cpu_usage(cgroup_path)
+            read_bytes, write_bytes = cgroup_manager.io_counters(cgroup_path)
+            if memory is not None:
+                samples[task_id] = (now, memory, cpu_time or 0.0, read_bytes, write_bytes)
+
+        # 其余任务通过一次 /proc 扫描得到 pid -> 任务 的映射
+        root_to_task = {pid: task_id for task_id, (pid, cgroup_path) in tasks.items() if not cgroup_path and pid}
+        if root_to_task:
+            children = {}
+            counters = {}
+            for entry in os.listdir('/proc'):
+                if not entry.isdigit():
+                    continue
+                pid = int(entry)
+                try:
+                    ppid, cpu_time, rss = read_proc_stat(pid)
+                except (OSError, ValueError, IndexError):
+                    continue
+                children.setdefault(ppid, []).append(pid)
+                counters[pid] = (cpu_time, rss) + read_proc_io(pid)
+
+            for root_pid, task_id in root_to_task.items():
+                if root_pid not in counters:
+                    continue
+                cpu_time, rss, read_bytes, write_bytes = 0.0, 0, 0, 0
+                stack = [root_pid]
+                while stack:
+                    pid = stack.pop()
+                    if pid in counters:
+                        counter = counters[pid]
+                        cpu_time += counter[0]
+                        rss += counter[1]
+                        read_bytes += counter[2]
+                        write_bytes += counter[3]
+                    stack.extend(children.get(pid, []))
+                samples[task_id] = (now, rss / (1024 ** 3), cpu_time, read_bytes, write_bytes)
+
+        with self.lock:
+            for task_id, sample in samples.items():
+                if task_id not in self.series:
+                    continue
+                self.series[task_id].append(sample)
+                self.peaks[task_id] = max(self.peaks[task_id], sample[1])
+
+    def memory(self, task_id):
+        """任务最近一次采样的内存占用(GB)，没有采样时返回 None"""
+        with self.lock:
+            series = self.series.get(task_id)
+            return series[-1][1] if series else None
+
+    def peak(self, task_id):
+        """任务运行以来采样到的内存峰值(GB)"""
+        with self.lock:
+            return self.peaks.get(task_id)
+
+    def cpu_time(self, task_id):
+        """任务最近一次采样的累计 CPU 时间(秒)，没有采样时返回 None"""
+        with self.lock:
+            series = self.series.get(task_id)
+            return series[-1][2] if series else None
+
+    def rate(self, task_id, window=None):
+        """返回任务在最近 window 秒内的 (CPU核数, 读字节/秒, 写字节/秒)，采样不足时返回全 0"""
+        with self.lock:
+            series = list(self.series.get(task_id, ()))
+        if len(series) < 2:
+            return 0.0, 0.0, 0.0
+        last = series[-1]
+        first = series[0]
+        if window is not None:
+            for sample in series:
+                if last[0] - sample[0] <= window:
+                    first = sample
+                    break
+        elapsed = last[0] - first[0]
+        if elapsed <= 0:
+            return 0.0, 0.0, 0.0
+        # 子进程退出后累计值会下降，差值为负时按 0 计算
+        return tuple(max(0.0, (last[i] - first[i]) / elapsed) for i in (2, 3, 4))
+
+    def io_rate(self, task_id, window=None):
+        """任务最近 window 秒内的读写速率(字节/秒)"""
+        _, read_rate, write_rate = self.rate(task_id, window)
+        return read_rate + write_rate
+
+
+# 单例实例
+telemetry_sampler = TelemetrySampler()
@@ -0,0 +1,209 @@
+import os
+import mmap
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from queue_system.config import global_config
+from scripts.a3m_utils import INSERTION_CHARS
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# 与 hhfilter 相同，只读取前 maxseq 条序列
+MAX_SEQ = 100000
+# 20 种标准氨基酸编码为 1..20，gap 为 0
+STANDARD_AMINO_ACIDS = b'ACDEFGHIKLMNPQRSTVWY'
+NUM_CODES = 20
+# 与 HH-suite 相同地将非标准氨基酸换为对应的标准氨基酸，X 和其他字母不计为残基，也不参与一致性比较
+AMBIGUOUS_AMINO_ACIDS = {b'B': b'D', b'Z': b'E', b'U': b'C', b'O': b'K'}
+# 每次与已保留序列比较的候选序列块大小，以及每个线程负责的已保留序列块大小
+BLOCK_SIZE = 256
+KEPT_CHUNK = 2048
+
+
+def get_filter_engine():
+    return global_config.get_args().get('msa_filter_engine', 'hhfilter')
+
+
+def read_records(a3m_file):
+    """读取 a3m 中每条序列的 (头部行, 原始序列)，用于按原样写出保留的序列"""
+    records = []
+    header, current = None, []
+    with open(a3m_file, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for line in iter(data.readline, b''):
+            line = line.rstrip()
+            if not line or line.startswith(b'#'):
+                continue
+            if line.startswith(b'>'):
+                if header is not None:
+                    records.append((header, b''.join(current)))
+                    if len(records) >= MAX_SEQ:
+                        return records
+                header, current = line, []
+            else:
+                current.append(line)
+        if header is not None:
+            records.append((header, b''.join(current)))
+    return records
+
+
+def encode(alignments, length):
+    """将去除插入状态后的比对串编码为 int8 矩阵"""
+    table = np.zeros(256, dtype=np.int8)
+    for code, aa in enumerate(STANDARD_AMINO_ACIDS, start=1):
+        table[aa] = code
+        table[ord(chr(aa).lower())] = code
+    for aa, standard in AMBIGUOUS_AMINO_ACIDS.items():
+        table[ord(aa)] = table[ord(aa.lower())] = table[ord(standard)]
+    matrix = np.frombuffer(b''.join(alignments), dtype=np.uint8).reshape(len(alignments), length)
+    return table[matrix]
+
+
+def one_hot(codes):
+    """每个氨基酸展开为 NUM_CODES 维的 0/1 向量，两条序列的相同残基数即为向量点积"""
+    return (codes[:, :, None] == np.arange(1, NUM_CODES + 1, dtype=np.int8)).reshape(len(codes), -1).astype(np.float32)
+
+
+class KeptSet:
+    """已保留序列的 one-hot、非 gap 掩码、残基数和所属的组，每条序列只编码一次
+    按候选序列数一次分配，未写入的页不占用物理内存，实际占用只随保留的序列增长，也不会因扩容复制而翻倍"""
+
+    def __init__(self, length, groups, capacity):
+        self.size = 0
+        self.hot = np.empty((capacity, length * NUM_CODES), dtype=np.float32)
+        self.res = np.empty((capacity, length), dtype=np.float32)
+        self.nres = np.empty(capacity, dtype=np.float32)
+        self.member = np.empty((capacity, groups), dtype=bool)
+
+    def append(self, hot, res, nres, member):
+        end = self.size + len(hot)
+        self.hot[self.size:end] = hot
+        self.res[self.size:end] = res
+        self.nres[self.size:end] = nres
+        self.member[self.size:end] = member
+        self.size = end
+
+
+def is_close(block_hot, block_res, block_nres, other_hot, other_res, other_nres, diff_frac):
+    """返回 (候选, 比较对象, 组) 的布尔矩阵: 两条序列在双方都非 gap 的列上的不同残基数低于该组阈值时视为冗余
+    hhfilter 中差异残基数低于 (1 - id) * 较短序列残基数时视为冗余"""
+    diff = block_res @ other_res.T - block_hot @ other_hot.T
+    return diff[:, :, None] < diff_frac * np.minimum(block_nres[:, None], other_nres[None, :])[:, :, None]
+
+
+def find_redundant(block_hot, block_res, block_nres, alive, kept_set, diff_frac, pool, threads):
+    """返回 (候选, 组) 的布尔矩阵: 候选序列在该组中与某条已保留序列冗余
+    已保留序列按保留顺序分块，每轮由线程池并行比较 threads 块，在所有组中都已冗余的候选不再参与之后的比较"""
+    redundant = np.zeros(alive.shape, dtype=bool)
+    rows = np.arange(len(alive))
+    for start in range(0, kept_set.size, KEPT_CHUNK * threads):
+        rows = rows[(alive[rows] & ~redundant[rows]).any(axis=1)]
+        if len(rows) == 0:
+            break
+
+        def compare(chunk_start):
+            chunk = slice(chunk_start, min(chunk_start + KEPT_CHUNK, kept_set.size))
+            close = is_close(block_hot[rows], block_res[rows], block_nres[rows], kept_set.hot[chunk], kept_set.res[chunk], kept_set.nres[chunk], diff_frac)
+            return (close & kept_set.member[chunk][None, :, :]).any(axis=1)
+
+        for result in pool.map(compare, range(start, min(start + KEPT_CHUNK * threads, kept_set.size), KEPT_CHUNK)):
+            redundant[rows] |= result
+    return redundant
+
+
+def filter_a3m(a3m_file, outputs, threads=1):
+    """一次读取 a3m，同时按多组 (输出文件, 最大一致性%, 最小覆盖度%) 过滤
+    与 hhfilter 相同：先去掉覆盖度不足的序列，再按残基数从多到少依次保留与已保留序列一致性都不超过阈值的序列，查询序列总是保留"""
+    records = read_records(a3m_file)
+    alignments = [sequence.translate(None, INSERTION_CHARS) for _, sequence in records]
+    length = len(alignments[0])
+    # 长度与查询不一致的记录无法比较，丢弃
+    valid = [index for index, alignment in enumerate(alignments) if len(alignment) == length]
+    codes = encode([alignments[index] for index in valid], length)
+    nres = (codes > 0).sum(axis=1).astype(np.float32)
+    coverage = 100.0 * nres / max(length, 1)
+
+    min_cov = np.array([cov for _, _, cov in outputs], dtype=np.float64)
+    diff_frac = np.array([0.9999 - 0.01 * seqid for _, seqid, _ in outputs], dtype=np.float64)
+
+    # 查询序列排在最前，其余按残基数从多到少稳定排序
+    order = [0] + sorted(range(1, len(valid)), key=lambda index: -nres[index])
+    order = [index for index in order if index == 0 or coverage[index] >= min_cov.min()]
+
+    kept = [0]  # 在任一组阈值下保留的序列
+    kept_set = KeptSet(length, len(outputs), len(order))
+    kept_set.append(one_hot(codes[:1]), (codes[:1] > 0).astype(np.float32), nres[:1], np.ones((1, len(outputs)), dtype=bool))
+    threads = max(1, threads)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for start in range(1, len(order), BLOCK_SIZE):
+            block = np.array(order[start:start + BLOCK_SIZE])
+            block_codes = codes[block]
+            block_nres = nres[block]
+            block_hot = one_hot(block_codes)
+            block_res = (block_codes > 0).astype(np.float32)
+            # 与块开始前已保留的序列一次性比较，块内序列之间再按顺序判断
+            alive = coverage[block][:, None] >= min_cov[None, :]
+            alive &= ~find_redundant(block_hot, block_res, block_nres, alive, kept_set, diff_frac, pool, threads)
+            close_self = is_close(block_hot, block_res, block_nres, block_hot, block_res, block_nres, diff_frac)
+            member = np.zeros(alive.shape, dtype=bool)
+            for i in np.flatnonzero(alive.any(axis=1)):
+                member[i] = alive[i] & ~(close_self[i, :i] & member[:i]).any(axis=0)
+            block_kept = np.flatnonzero(member.any(axis=1))
+            kept.extend(int(block[i]) for i in block_kept)
+            kept_set.append(block_hot[block_kept], block_res[block_kept], block_nres[block_kept], member[block_kept])
+
+    for column, (output, seqid, cov) in enumerate(outputs):
+        selected = sorted(valid[index] for index, member in zip(kept, kept_set.member[:kept_set.size]) if member[column])
+        tmp_file = f"{output}.tmp.{os.getpid()}"
+        with open(tmp_file, 'wb') as file:
+            for index in selected:
+                header, sequence = records[index]
+                file.write(header + b'\n' + sequence + b'\n')
+        os.replace(tmp_file, output)
+        print(f"过滤 {a3m_file} (id {seqid}%, cov {cov}%): {len(records)} -> {len(selected)} 条序列，写出 {output}")
+
+
+def run_filters(a3m_file, outputs, cpu):
+    """按配置选择过滤方式，已存在的输出跳过；native 方式一次读取同时写出所有阈值组合，缺少 NumPy 时退回 hhfilter"""
+    outputs = [output for output in outputs if not os.path.exists(output[0])]
+    if not outputs:
+        return
+    if get_filter_engine() == 'native':
+        if np is not None:
+            filter_a3m(a3m_file, outputs, threads=cpu)
+            if global_config.get_args().get('msa_filter_verify', False):
+                verify_filters(a3m_file, outputs)
+            return
+        print("未安装 NumPy，使用 hhfilter 过滤")
+    for output, seqid, cov in outputs:
+        run_hhfilter(a3m_file, output, seqid, cov)
+
+
+def run_hhfilter(a3m_file, output, seqid, cov):
+    cmd = f"""
+    hhfilter -maxseq {MAX_SEQ} -id {seqid} -cov {cov} -i {a3m_file} -o {output}
+    """
+    print(cmd)
+    subprocess.run(cmd, shell=True, check=True)
+
+
+def read_headers(a3m_file):
+    with open(a3m_file, 'rb') as file:
+        return sorted(line.rstrip() for line in file if line.startswith(b'>'))
+
+
+def verify_filters(a3m_file, outputs):
+    """用 hhfilter 重新过滤并比较保留的序列，不一致时记录差异并使用 hhfilter 的结果，使阈值判断与 hhfilter 相同"""
+    for output, seqid, cov in outputs:
+        reference = f"{output}.hhfilter.{os.getpid()}"
+        run_hhfilter(a3m_file, reference, seqid, cov)
+        native_headers, reference_headers = read_headers(output), read_headers(reference)
+        if native_headers == reference_headers:
+            os.remove(reference)
+            continue
+        print(f"native 过滤结果与 hhfilter 不一致 {output} (id {seqid}%, cov {cov}%): "
+              f"native {len(native_headers)} 条, hhfilter {len(reference_headers)} 条, 使用 hhfilter 的结果")
+        os.replace(reference, output)
@@ -0,0 +1,104 @@
+import os
+import math
+import mmap
+import errno
+import shutil
+
+
+# a3m 中小写字母和 '.' 为插入状态，不属于与查询序列对齐的列
+INSERTION_CHARS = b'abcdefghijklmnopqrstuvwxyz.'
+AMINO_ACIDS = b'ACDEFGHIKLMNPQRSTVWXYZBUO'
+
+
+def count_sequences(a3m_file):
+    """通过内存映射统计 a3m 中的序列条数，与 grep -c '^>' 结果相同"""
+    if os.path.getsize(a3m_file) == 0:
+        return 0
+    with open(a3m_file, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        count = 1 if data[:1] == b'>' else 0
+        position = data.find(b'\n>')
+        while position != -1:
+            count += 1
+            position = data.find(b'\n>', position + 2)
+    return count
+
+
+def read_match_states(a3m_file):
+    """逐条读取 a3m，返回每条序列去除插入状态后与查询等长的比对串"""
+    records = []
+    current = []
+    with open(a3m_file, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for line in iter(data.readline, b''):
+            line = line.rstrip()
+            if not line or line.startswith(b'#'):
+                continue
+            if line.startswith(b'>'):
+                if current:
+                    records.append(b''.join(current).translate(None, INSERTION_CHARS))
+                current = []
+            else:
+                current.append(line)
+        if current:
+            records.append(b''.join(current).translate(None, INSERTION_CHARS))
+    return records
+
+
+def get_a3m_stats(a3m_file):
+    """一次扫描得到序列条数、Neff、平均覆盖度、对齐列数和文件大小(MB)
+    Neff 取各对齐列氨基酸分布熵的指数的平均值，序列不加权、不计 gap，只是 HH-suite 中按序列加权的 Neff 的粗略近似
+    覆盖度为非查询序列在对齐列上非 gap 的比例"""
+    size_mb = os.path.getsize(a3m_file) / 1024 ** 2
+    if size_mb == 0:
+        return {"nseq": 0, "neff": 0.0, "coverage": 0.0, "ncol": 0, "size_mb": 0.0}
+    records = read_match_states(a3m_file)
+    if not records:
+        # 只有注释或空行的文件没有序列
+        return {"nseq": 0, "neff": 0.0, "coverage": 0.0, "ncol": 0, "size_mb": size_mb}
+    length = len(records[0])
+    # 长度与查询不一致的记录无法按列统计，跳过
+    records = [record for record in records if len(record) == length]
+    nseq = len(records)
+    if length == 0:
+        return {"nseq": nseq, "neff": 0.0, "coverage": 0.0, "ncol": 0, "size_mb": size_mb}
+
+    # 所有比对串拼接后按步长切片即可取出一列，计数在 C 层完成
+    alignment = b''.join(records)
+    neff_sum = 0.0
+    covered = 0
+    for column in range(length):
+        residues = alignment[column::length]
+        counts = [residues.count(aa) for aa in AMINO_ACIDS]
+        total = sum(counts)
+        # 第一条为查询序列，不计入覆盖度
+        covered += total - (1 if records[0][column:column + 1] != b'-' else 0)
+        if total == 0:
+            neff_sum += 1.0
+            continue
+        entropy = -sum(count / total * math.log(count / total) for count in counts if count)
+        neff_sum += math.exp(entropy)
+
+    coverage = covered / ((nseq - 1) * length) if nseq > 1 else 0.0
+    return {"nseq": nseq, "neff": neff_sum / length, "coverage": coverage, "ncol": length, "size_mb": size_mb}
+
+
+def commit(src, dst):
+    """将 src 排他地发布为 dst，dst 已存在时不覆盖并返回 False
+    多个分支同时得到结果时只有第一个创建链接的分支提交成功"""
+    try:
+        os.link(src, dst)
+        return True
+    except FileExistsError:
+        return False
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+    # 无法硬链接时先复制到目标目录，再在同一文件系统内排他地链接
+    tmp_dst = f"{dst}.tmp.{os.getpid()}"
+    shutil.copyfile(src, tmp_dst)
+    try:
+        os.link(tmp_dst, dst)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp_dst)
@@ -1,54 +1,27 @@
-# 小根堆
-def hhsearch_priority(task_element):
-    weight = {"time": 0.5, "mem": 0.2, "len": 0.3}
-    priority = weight["time"] * task_element.time + weight["mem"] * task_element.mem + weight["len"] * task_element.len
-
-    return priority
-
-
-def psipred_priority(task_element):
-    weight = {"time": 0.5, "mem": 0.2, "len": 0.3}
-    priority = weight["time"] * task_element.time + weight["mem"] * task_element.mem + weight["len"] * task_element.len
-
-    return priority
-
-
-def signalp6_priority(task_element):
-    weight = {"mem": 0.4, "len": 0.6}
-    priority = weight["mem"] * task_element.mem + weight["len"] * task_element.len
-
-    return priority
+from queue_system.config import global_config
+from queue_system.pipeline import pipeline
+from scripts.runtime_model import runtime_model
 
 
-def hhblits_bfd_priority(task_element):
-    weight = {"time": 0.5, "mem": 0.3, "len": 0.2}
-    priority = weight["time"] * task_element.time + weight["mem"] * task_element.mem + weight["len"] * task_element.len
+# 小根堆，各步骤的权重在流程图节点的 priority_weights 中配置
+def weighted_priority(task_element):
+    weights = pipeline.get_priority_weights(task_element.step)
+    priority = sum(weight * getattr(task_element, key) for key, weight in weights.items())
 
     return priority
 
 
-def hhblits_uniref_1_priority(task_element):
-    weight = {"time": 0.4, "mem": 0.4, "len": 0.2}
-    priority = weight["time"] * task_element.time + weight["mem"] * task_element.mem + weight["len"] * task_element.len
+# 小根堆，预计剩余流程时间越短越先执行，等待时间作为老化项防止长任务饿死
+def sept_priority(task_element):
+    aging_rate = global_config.get_args().get('sept_aging_rate', 1.0)
+    # 当前步骤及其后续步骤，并行的分支取最长者，hhblits 阶梯按最先结束的路径计算
+    expected_time = pipeline.get_remaining_time(task_element.step, lambda step: runtime_model.predict(step, task_element.len))
+    # expected_time - aging_rate * (now - time) 与 expected_time + aging_rate * time 的排序相同
+    priority = expected_time + aging_rate * task_element.time
 
     return priority
 
 
-def hhblits_uniref_2_priority(task_element):
-    weight = {"time": 0.3, "mem": 0.4, "len": 0.3}
-    priority = weight["time"] * task_element.time + weight["mem"] * task_element.mem + weight["len"] * task_element.len
-
-    return priority
-
-
-def hhblits_uniref_3_priority(task_element):
-    weight = {"time": 0.2, "mem": 0.4, "len": 0.4}
-    priority = weight["time"] * task_element.time + weight["mem"] * task_element.mem + weight["len"] * task_element.len
-
-    return priority
-
-
-
 def normal_priority(task_element):
 
     return task_element.time
@@ -63,16 +36,9 @@ def excess_priority(task_element):
 def suspend_priority(task_element):
 
     return (task_element.time * -1)
-    
+
 
 queue_type_to_function = {
-    "hhsearch": hhsearch_priority,
-    "psipred": psipred_priority,
-    "signalp6": signalp6_priority,
-    "hhblits_bfd": hhblits_bfd_priority,
-    "hhblits_uniref_1": hhblits_uniref_1_priority,
-    "hhblits_uniref_2": hhblits_uniref_2_priority,
-    "hhblits_uniref_3": hhblits_uniref_3_priority,
     "normal": normal_priority,
     "excess": excess_priority,
     "suspend": suspend_priority
@@ -80,6 +46,11 @@ queue_type_to_function = {
 
 
 def calculate_priority(queue_type, task_element):
-    if queue_type not in queue_type_to_function:
+    if queue_type in queue_type_to_function:
+        return queue_type_to_function[queue_type](task_element)
+    if not pipeline.has_step(queue_type):
         raise ValueError(f"Invalid queue_type: {queue_type}")
-    return queue_type_to_function[queue_type](task_element)
+    # sept 策略下各步骤就绪队列按预计剩余流程时间排序，weighted 策略使用流程图中配置的权重
+    if global_config.get_args().get('priority_policy', 'sept') == 'sept':
+        return sept_priority(task_element)
+    return weighted_priority(task_element)
@@ -1,9 +1,10 @@
 import os
 import yaml
 
-from queue_system.task_element import TaskElement
 from queue_system.queue_ready import queue_ready
+from queue_system.pipeline import pipeline
 from scripts.utilities import get_job_mem_num, get_job_core_num, get_fasta_seq_len
+from scripts.result_cache import result_cache
 
 
 def initialize_queue(args):
@@ -11,7 +12,6 @@ def initialize_queue(args):
 
     input_config_path = args["input_config_path"]
     output_path = args["output_path"]
-    initial_step = args["initial_step"]
 
     # 首先读入每个配置文件并创建任务元素
     # 检查input_config_path路径是否存在
@@ -20,6 +20,9 @@ def initialize_queue(args):
         return
 
 
+    # 序列缓存键 -> 首个提交该序列的蛋白的任务参数，相同序列的后续输入作为等待者挂在其上，不单独占用资源
+    leaders = {}
+
     # 遍历 input_config_path 中的所有 yaml 文件
     job_count = 1
     for filename in os.listdir(input_config_path):
@@ -53,22 +56,42 @@ def initialize_queue(args):
     
                     job_output_path = os.path.join(output_path, job_name, protein_index)
                     if fasta_file:
+                        # 相同序列已有完整结果时直接从缓存取出，跳过整个流程
+                        cache_key = result_cache.get_key(fasta_file)
+                        if result_cache.lookup(cache_key, job_output_path):
+                            continue
+
+                        if cache_key in leaders:
+                            leader = leaders[cache_key]
+                            # 同一蛋白的各步骤任务共享同一个等待者列表
+                            leader['waiters'].append({
+                                "job_name": job_name,
+                                "job_output_path": job_output_path,
+                                "fasta_file": fasta_file
+                            })
+                            print(f"{job_name}/{protein_index} 与 {leader['job_output_path']} 序列相同，等待其完成后共享结果")
+                            continue
+
                         # 获取序列长度
                         seq_length = get_fasta_seq_len(fasta_file)
 
                         task_params = {
                             "job_name": job_name,
                             "job_output_path": job_output_path,
-                            "fasta_file": fasta_file
+                            "fasta_file": fasta_file,
+                            "cache_key": cache_key,
+                            "waiters": []
                         }
 
-                        task_element = TaskElement(initial_step, seq_length, task_params)
+                        leaders[cache_key] = task_params
 
-                        # 获取任务所需的内存和核心数
-                        task_element.mem = get_job_mem_num(task_element)
-                        task_element.core = get_job_core_num(task_element)
+                        # 流程图中没有依赖的步骤同时加入就绪队列
+                        for task_element in pipeline.start(task_params, seq_length):
+                            # 获取任务所需的内存和核心数
+                            task_element.mem = get_job_mem_num(task_element)
+                            task_element.core = get_job_core_num(task_element)
 
-                        queue_ready.add_task(task_element)
+                            queue_ready.add_task(task_element)
             except yaml.YAMLError as e:
                 print(f"Error reading {filename}: {e}")
 
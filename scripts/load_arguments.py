@@ -26,7 +26,7 @@ def merge_params(default_params, user_params):
 
 # Validate required parameters
 def validate_params(params):
-    required_keys = ["input_config_path", "output_path", "job_core_num", "job_mem_num"]
+    required_keys = ["input_config_path", "output_path", "job_core_num", "job_mem_num", "pipeline"]
     missing_keys = [key for key in required_keys if key not in params]
     if missing_keys:
         print(f"Error: Missing required parameter(s): {', '.join(missing_keys)}")
@@ -0,0 +1,100 @@
+import os
+import json
+import math
+
+from queue_system.config import global_config
+
+
+# 序列长度区间边界: [100, 200, 300, 400, 500, 600, 700, 800, 900, 1000, 2000, inf]
+LENGTH_BOUNDS = [100 * i for i in range(1, 11)] + [2000, float('inf')]
+
+
+def get_len_bucket(seq_length):
+    # 根据序列长度找到对应区间的下标
+    for i, bound in enumerate(LENGTH_BOUNDS):
+        if seq_length < bound:
+            return i
+
+
+class MemoryModel:
+    """按步骤和序列长度区间记录任务实际内存峰值，用高分位数估计内存需求"""
+
+    def __init__(self):
+        self.loaded = False
+        self.path = None
+        self.quantile = 0.95
+        self.margin = 0.1
+        self.min_samples = 5
+        self.max_samples = 200
+        self.samples = {}  # step -> [[峰值内存(GB), ...] * len(LENGTH_BOUNDS)]
+        self.dirty = False
+
+    def load(self):
+        """从配置文件读取模型参数，并加载上次运行保存的观测值"""
+        args = global_config.get_args()
+        self.path = args.get('mem_model_path')
+        self.quantile = args.get('mem_model_quantile', self.quantile)
+        self.margin = args.get('mem_model_margin', self.margin)
+        self.min_samples = args.get('mem_model_min_samples', self.min_samples)
+        self.max_samples = args.get('mem_model_max_samples', self.max_samples)
+        self.loaded = True
+
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as file:
+                self.samples = json.load(file)
+            print(f"Loaded memory model from {self.path}")
+        except (OSError, ValueError) as e:
+            print(f"Error loading memory model {self.path}: {e}, starting from the static table")
+            self.samples = {}
+
+    def save(self):
+        """原子地写回模型文件，供下次运行继续使用"""
+        if not self.dirty or not self.path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(self.samples, file)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def record(self, step, seq_length, peak_mem):
+        """记录一次已完成任务的实际内存峰值(GB)"""
+        if not self.loaded:
+            self.load()
+        if not self.path or peak_mem is None:
+            return
+        buckets = self.samples.setdefault(step, [[] for _ in LENGTH_BOUNDS])
+        bucket = buckets[get_len_bucket(seq_length)]
+        bucket.append(round(peak_mem, 3))
+        # 只保留最近的观测值，使模型跟随数据库和软件版本的变化
+        if len(bucket) > self.max_samples:
+            del bucket[:len(bucket) - self.max_samples]
+        self.dirty = True
+
+    def estimate(self, step, seq_length, prior):
+        """估计任务内存需求(GB)，观测值不足时使用静态表中的先验值"""
+        if not self.loaded:
+            self.load()
+        buckets = self.samples.get(step)
+        if not buckets:
+            return prior
+        bucket = sorted(buckets[get_len_bucket(seq_length)])
+        if len(bucket) < self.min_samples:
+            return prior
+
+        # 线性插值计算高分位数，再加上安全余量
+        position = (len(bucket) - 1) * self.quantile
+        lower = math.floor(position)
+        upper = min(lower + 1, len(bucket) - 1)
+        value = bucket[lower] + (bucket[upper] - bucket[lower]) * (position - lower)
+        mem = value * (1 + self.margin)
+
+        # 向上取整到 0.5GB
+        return max(math.ceil(mem * 2) / 2, 0.5)
+
+
+# 单例实例
+memory_model = MemoryModel()
@@ -0,0 +1,123 @@
+import os
+import shutil
+import subprocess
+
+from queue_system.task_element import TaskElement
+from queue_system.queue_finished import queue_finished
+from queue_system.pipeline import pipeline
+from scripts.msa_hhblits_uniref import run_hhblits_uniref
+from scripts.msa_hhblits_bfd import run_hhblits_bfd
+from scripts.utilities import get_intermediate_a3m
+
+
+def is_batchable(task_element):
+    """hhblits 步骤且搜索结果尚未写出的任务可以合并成批运行"""
+    if not pipeline.get_runner(task_element.step).startswith('hhblits'):
+        return False
+    params = task_element.params
+    if params.get('batch_tasks') or params.get('no_batch'):
+        return False
+    if os.path.exists(os.path.join(params['job_output_path'], "t000_.msa0.a3m")):
+        return False
+    return not os.path.exists(get_intermediate_a3m(task_element))
+
+
+def get_batch_mem(members, core):
+    """hhblits_omp 同时处理 core 个查询，每个查询按成员中最大的预分配内存计算"""
+    return max(task_element.mem for task_element in members) * min(len(members), core)
+
+
+def make_batch_task(members, output_path):
+    """将同一步骤的多个任务合并为一个批量任务，成员任务保存在参数 batch_tasks 中"""
+    first = members[0]
+    batch_task = TaskElement(first.step, max(task_element.len for task_element in members), {})
+    batch_dir = os.path.join(output_path, "batches", batch_task.id)
+    batch_task.params = {
+        "job_name": f"batch_{batch_task.id}",
+        "job_output_path": batch_dir,
+        "fasta_file": os.path.join(batch_dir, "queries"),  # 查询序列的 ffindex 数据库前缀
+        "e_value": first.params['e_value'],
+        "batch_tasks": members,
+    }
+    batch_task.core = first.core
+    batch_task.mem = get_batch_mem(members, first.core)
+    print(f"合并 {len(members)} 个 {first.step} 任务为批量任务 {batch_task.id}: {[task_element.id for task_element in members]}")
+    return batch_task
+
+
+def write_query_ffindex(members, query_db):
+    """将每个成员的查询序列写入 ffindex 数据库，条目名为任务 id"""
+    query_dir = f"{query_db}_files"
+    os.makedirs(query_dir, exist_ok=True)
+    for task_element in members:
+        shutil.copyfile(task_element.params['fasta_file'], os.path.join(query_dir, task_element.id))
+
+    for suffix in ('.ffdata', '.ffindex'):
+        if os.path.exists(query_db + suffix):
+            os.remove(query_db + suffix)
+    cmd = f"""
+    ffindex_build -s {query_db}.ffdata {query_db}.ffindex {query_dir}
+    """
+    print(cmd)
+    subprocess.run(cmd, shell=True, check=True)
+
+
+def split_result_ffindex(result_db, members):
+    """从 hhblits_omp 输出的 ffindex 数据库中取出每个成员的 a3m，原子地写到单独运行时的路径"""
+    with open(f"{result_db}.ffdata", 'rb') as file:
+        data = file.read()
+    entries = {}
+    with open(f"{result_db}.ffindex", 'r') as file:
+        for line in file:
+            name, offset, length = line.split()
+            entries[name] = (int(offset), int(length))
+
+    for task_element in members:
+        if task_element.id not in entries:
+            print(f"批量结果中缺少任务 {task_element.id}")
+            continue
+        offset, length = entries[task_element.id]
+        # ffdata 中每个条目以 \0 结尾
+        a3m_file = get_intermediate_a3m(task_element)
+        os.makedirs(os.path.dirname(a3m_file), exist_ok=True)
+        tmp_file = f"{a3m_file}.tmp"
+        with open(tmp_file, 'wb') as file:
+            file.write(data[offset:offset + length].rstrip(b'\0'))
+        os.replace(tmp_file, a3m_file)
+
+
+def run_hhblits_batch(cpu, mem, db, log_file, task_element):
+    """对批量任务的所有查询只扫描一次数据库，再对每个成员继续单独运行时的过滤和阈值判断"""
+    params = task_element.params
+    members = params['batch_tasks']
+    batch_dir = params['job_output_path']
+    e_value = params['e_value']
+    os.makedirs(batch_dir, exist_ok=True)
+
+    query_db = params['fasta_file']
+    write_query_ffindex(members, query_db)
+    result_db = os.path.join(batch_dir, "result_a3m")
+    HHBLITS_OMP = f"hhblits_omp -mact 0.35 -maxfilt 100000000 -neffmax 20 -cov 25 -cpu {cpu} -nodiff -realign_max 100000000 -maxseq 1000000 -maxmem {mem} -n 4 -d {db}"
+    cmd = f"""
+    {HHBLITS_OMP} -i {query_db} -oa3m {result_db} -e {e_value} -v 0
+    """
+    print(cmd)
+    subprocess.run(cmd, shell=True, check=True)
+    split_result_ffindex(result_db, members)
+
+    # 搜索结果已写出，单独运行的步骤函数会跳过 hhblits，只进行过滤并上报各成员的下一步骤
+    for member in members:
+        member_params = member.params
+        try:
+            if pipeline.get_runner(member.step) == 'hhblits_bfd':
+                run_hhblits_bfd(member_params['job_output_path'], member_params['fasta_file'], cpu, mem, db, member_params['e_value'], log_file, member)
+            else:
+                run_hhblits_uniref(member_params['job_output_path'], member_params['fasta_file'], cpu, mem, db, member_params['e_value'], log_file, member)
+        except Exception as e:
+            print(f"批量任务 {task_element.id} 的成员 {member.id} 处理失败: {e}")
+            queue_finished.report('failed', member)
+
+    shutil.rmtree(batch_dir, ignore_errors=True)
+    # 所有成员已分别上报，批量任务本身没有下一步骤
+    task_element.step = None
+    queue_finished.add_task(task_element)
@@ -2,30 +2,26 @@ import os
 import subprocess
 
 from queue_system.queue_finished import queue_finished
-from queue_system.queue_ready import queue_ready
-from scripts.utilities import get_job_mem_num, get_job_core_num
+from scripts.a3m_utils import count_sequences, get_a3m_stats, commit
+from scripts.a3m_filter import run_filters
+from scripts.msa_hhblits_uniref import hand_off_filter
+from scripts.utilities import get_a3m_tag
+from queue_system.pipeline import pipeline
 
 
 def task_complete(task_element):
     print(f'{task_element.step} step of {task_element.params["job_name"]} finished')
 
-    # 将任务加入finished队列等待资源回收
-    queue_finished.add_task(task_element)
-
-    # 修改参数为下一步 psipred 的相关参数
-    task_element.step = "psipred"
+    # 阶梯结束，后续步骤由调度器按流程图分派；推测执行的分支只负责尝试提交结果
+    task_element.step = None
+    print(f'任务{task_element}参数修改完毕，上报调度器回收资源')
 
-    # 获取任务所需的内存和核心数
-    task_element.mem = get_job_mem_num(task_element)
-    task_element.core = get_job_core_num(task_element)
-    print(f'任务{task_element}参数修改完毕，加入ready队列等待资源分配')
-    
-    # 将任务加入ready队列等待资源分配
-    queue_ready.add_task(task_element)
+    # 上报调度器，由调度器回收资源、计算下一步所需资源并加入ready队列
+    queue_finished.add_task(task_element)
 
 
 # e_values = 1e-3
-def run_hhblits_bfd(out_dir, in_fasta, cpu, mem, db_bfd, e_value, log_file, task_element):
+def run_hhblits_bfd(out_dir, in_fasta, cpu, mem, db_bfd, e_value, log_file, task_element, filter_only=False):
     final_msa = os.path.join(out_dir, "t000_.msa0.a3m")
     tmp_dir = os.path.join(out_dir, "hhblits")
     os.makedirs(tmp_dir, exist_ok=True)
@@ -35,61 +31,58 @@ def run_hhblits_bfd(out_dir, in_fasta, cpu, mem, db_bfd, e_value, log_file, task
     if not os.path.exists(final_msa):
         # <<< Run HHblits against BFD >>>
         print(f"Running HHblits against BFD with E-value cutoff {e_value}")
-        a3m_file = os.path.join(tmp_dir, f"t000_.{e_value}.bfd.a3m")
+        tag = get_a3m_tag(task_element.params)
+        a3m_file = os.path.join(tmp_dir, f"t000_.{e_value}{tag}.bfd.a3m")
+        a3m_file_id90cov75 = os.path.join(tmp_dir, f"t000_.{e_value}{tag}.id90cov75.bfd.a3m")
+        a3m_file_id90cov50 = os.path.join(tmp_dir, f"t000_.{e_value}{tag}.id90cov50.bfd.a3m")
+        if tag and not filter_only:
+            # 推测分支每次都重新搜索，不使用之前以其他输入推测留下的结果
+            for path in (a3m_file, a3m_file_id90cov75, a3m_file_id90cov50):
+                if os.path.exists(path):
+                    os.remove(path)
         if not os.path.exists(a3m_file):
+            # 先写到临时文件，被取消或杀死的任务不会留下不完整的 a3m
             cmd = f"""
-            {HHBLITS_BFD} -i {in_fasta} -oa3m {a3m_file} -e {e_value} -v 0
+            {HHBLITS_BFD} -i {in_fasta} -oa3m {a3m_file}.tmp -e {e_value} -v 0
             """
             print(cmd)
             subprocess.run(cmd, shell=True, check=True)
+            os.replace(f"{a3m_file}.tmp", a3m_file)
         else:
             print(f"Found {a3m_file}, skipping HHblits against BFD with E-value cutoff {e_value}.")
 
 
-        # <<< Run hhfilter with 90% identity and 75% coverage >>>
-        a3m_file_id90cov75 = os.path.join(tmp_dir, f"t000_.{e_value}.id90cov75.bfd.a3m")
-        if not os.path.exists(a3m_file_id90cov75):
-            print(f"Running hhfilter on {final_msa} with E-value cutoff {e_value}, 90% identity, and 75% coverage")
-            cmd = f"""
-            hhfilter -maxseq 100000 -id 90 -cov 75 -i {a3m_file} -o {a3m_file_id90cov75}
-            """
-            print(cmd)
-            subprocess.run(cmd, shell=True, check=True)
-        else:
-            print(f"Found {a3m_file_id90cov75}, skipping HHfilter with 90% identity and 75% coverage.")
-
+        # <<< Run hhfilter with 90% identity and 75% / 50% coverage >>>
+        if not filter_only and pipeline.get_filter(task_element.step) and not (os.path.exists(a3m_file_id90cov75) and os.path.exists(a3m_file_id90cov50)):
+            hand_off_filter(task_element)
+            return
+        # 两种覆盖度都需要，native 方式只读取一次 a3m，hhfilter 方式依次运行，已存在的结果跳过
+        run_filters(a3m_file, [(a3m_file_id90cov75, 90, 75), (a3m_file_id90cov50, 90, 50)], cpu)
 
-        # <<< Run hhfilter with 90% identity and 50% coverage >>>
-        a3m_file_id90cov50 = os.path.join(tmp_dir, f"t000_.{e_value}.id90cov50.bfd.a3m")
-        if not os.path.exists(a3m_file_id90cov50):
-            print(f"Running hhfilter on {final_msa} with E-value cutoff {e_value}, 90% identity, and 50% coverage")
-            cmd = f"""
-            hhfilter -maxseq 100000 -id 90 -cov 50 -i {a3m_file} -o {a3m_file_id90cov50}
-            """
-            print(cmd)
-            subprocess.run(cmd, shell=True, check=True)
-        else:
-            print(f"Found {a3m_file_id90cov50}, skipping HHfilter with 90% identity and 50% coverage.")
-    
 
         # <<< Check the number of sequences in the filtered a3m file >>>
-        n75 = int(subprocess.getoutput(f"grep -c '^>' {a3m_file_id90cov75}"))
-        n50 = int(subprocess.getoutput(f"grep -c '^>' {a3m_file_id90cov50}"))
-        if n75 > 2000 and not os.path.exists(final_msa):
-            os.system(f"cp {a3m_file_id90cov75} {final_msa}")
+        n75 = count_sequences(a3m_file_id90cov75)
+        n50 = count_sequences(a3m_file_id90cov50)
+        # 并行的其他分支可能已提交结果，只有第一个提交的分支写出 final_msa
+        if n75 > 2000:
+            task_element.params["committed"] = commit(a3m_file_id90cov75, final_msa)
             print(f"Found {n75} sequences in {a3m_file_id90cov75}, finishing the HHblits process.")
             
-        elif n50 > 4000 and not os.path.exists(final_msa):
-            os.system(f"cp {a3m_file_id90cov50} {final_msa}")
+        elif n50 > 4000:
+            task_element.params["committed"] = commit(a3m_file_id90cov50, final_msa)
             print(f"Found {n50} sequences in {a3m_file_id90cov50}, finishing the HHblits process.")
             
-        else:
-            os.system(f"cp {a3m_file_id90cov50} {final_msa}")
+        elif not task_element.params.get('speculative'):
+            # 推测分支不提交不足阈值的结果，由主线在 UniRef30 各级都不满足时提交
+            task_element.params["committed"] = commit(a3m_file_id90cov50, final_msa)
             print(f"Failed to get enough sequences from BFD, using {a3m_file_id90cov50} with {n50} sequences as the final MSA.")
         
 
     else:
         print(f"Found final result file: {final_msa}, skipping HHblits process.")
+
+    if os.path.exists(final_msa):
+        task_element.msa_stats = get_a3m_stats(final_msa)
     
     
     task_complete(task_element)
\ No newline at end of file
@@ -0,0 +1,20 @@
+import os
+
+from queue_system.pipeline import pipeline
+from scripts.msa_hhblits_uniref import run_hhblits_uniref
+from scripts.msa_hhblits_bfd import run_hhblits_bfd
+from scripts.utilities import get_intermediate_a3m
+
+
+def run_hhblits_filter(out_dir, in_fasta, cpu, e_value, log_file, task_element):
+    """对搜索步骤输出的 a3m 进行过滤和阈值判断，之后沿搜索步骤的条件边继续或结束阶梯"""
+    # 恢复为搜索步骤，阈值判断和下一级的选择都按搜索步骤进行，搜索结果已存在时不会重新搜索
+    task_element.step = task_element.params.pop('search_step')
+    # 过滤任务没有搜索所需的内存和数据库，搜索输出缺失时直接失败，不能退回到搜索
+    a3m_file = get_intermediate_a3m(task_element)
+    if not os.path.exists(os.path.join(out_dir, "t000_.msa0.a3m")) and not os.path.exists(a3m_file):
+        raise FileNotFoundError(f"{task_element.step} 的搜索输出 {a3m_file} 不存在，无法过滤")
+    if pipeline.get_runner(task_element.step) == 'hhblits_bfd':
+        run_hhblits_bfd(out_dir, in_fasta, cpu, None, None, e_value, log_file, task_element, filter_only=True)
+    else:
+        run_hhblits_uniref(out_dir, in_fasta, cpu, None, None, e_value, log_file, task_element, filter_only=True)
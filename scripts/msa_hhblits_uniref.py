@@ -2,36 +2,37 @@ import os
 import subprocess
 
 from queue_system.queue_finished import queue_finished
-from queue_system.queue_ready import queue_ready
-from scripts.utilities import get_job_mem_num, get_job_core_num
+from queue_system.pipeline import pipeline
+from scripts.a3m_utils import count_sequences, get_a3m_stats, commit
+from scripts.a3m_filter import get_filter_engine, run_filters
+from scripts.utilities import get_next_rung, get_a3m_tag
 
 def task_complete(task_element, terminate):
     print(f'{task_element.step} step of {task_element.params["job_name"]} finished')
 
-    # 将任务加入finished队列等待资源回收
+    # 推测执行的分支只负责尝试提交结果，流程由主线继续
+    # 已经得到充足数量的msa，阶梯结束，后续步骤由调度器按流程图分派
+    if task_element.params.get('speculative') or terminate:
+        task_element.step = None
+    print(f'任务{task_element}参数修改完毕，上报调度器回收资源并加入ready队列')
+
+    # 上报调度器，由调度器回收资源、计算下一步所需资源并加入ready队列
     queue_finished.add_task(task_element)
 
-    # 已经得到充足数量的msa，进行psipred操作
-    if terminate:
-        # 修改任务类型
-        task_element.step = "psipred"
 
-    # 获取任务所需的内存和核心数
-    task_element.mem = get_job_mem_num(task_element)
-    task_element.core = get_job_core_num(task_element)
-    print(f'任务{task_element}参数修改完毕，加入ready队列等待资源分配')
-    
-    # 将任务加入ready队列等待资源分配
-    queue_ready.add_task(task_element)
+def hand_off_filter(task_element):
+    """搜索结束后将过滤和阈值判断交给单独调度的过滤步骤，搜索预留的核和内存随之释放"""
+    params = task_element.params
+    params["search_step"] = task_element.step
+    task_element.step = pipeline.get_filter(task_element.step)
+    print(f'{params["search_step"]} search of {params["job_name"]} finished, filtering in step {task_element.step}')
+    queue_finished.add_task(task_element)
 
 
-def run_hhblits_uniref(out_dir, in_fasta, cpu, mem, db_ur30, e_value, log_file, task_element):
+def run_hhblits_uniref(out_dir, in_fasta, cpu, mem, db_ur30, e_value, log_file, task_element, filter_only=False):
     # 标识目前是否需要继续下一步hhblits操作
     terminate = False
 
-    # e_value的列表，其中也包括了 hhblits_bfd 的，因为最后切换任务需要
-    e_value_list = [1e-10, 1e-6, 1e-3, 1e-3]
-
     final_msa = os.path.join(out_dir, "t000_.msa0.a3m")
     tmp_dir = os.path.join(out_dir, "hhblits")
     os.makedirs(tmp_dir, exist_ok=True)
@@ -41,19 +42,35 @@ def run_hhblits_uniref(out_dir, in_fasta, cpu, mem, db_ur30, e_value, log_file,
     if not os.path.exists(final_msa):
         # <<< Run HHblits against UniRef30 >>>
         print(f"Running HHblits against UniRef30 with E-value cutoff {e_value}")
-        a3m_file = os.path.join(tmp_dir, f"t000_.{e_value}.a3m")
+        tag = get_a3m_tag(task_element.params)
+        a3m_file = os.path.join(tmp_dir, f"t000_.{e_value}{tag}.a3m")
+        a3m_file_id90cov75 = os.path.join(tmp_dir, f"t000_.{e_value}{tag}.id90cov75.a3m")
+        a3m_file_id90cov50 = os.path.join(tmp_dir, f"t000_.{e_value}{tag}.id90cov50.a3m")
+        if tag and not filter_only:
+            # 推测分支每次都重新搜索，不使用之前以其他输入推测留下的结果
+            for path in (a3m_file, a3m_file_id90cov75, a3m_file_id90cov50):
+                if os.path.exists(path):
+                    os.remove(path)
         if not os.path.exists(a3m_file):
+            # 先写到临时文件，被取消或杀死的任务不会留下不完整的 a3m
             cmd = f"""
-            {HHBLITS_UR30} -i {in_fasta} -oa3m {a3m_file} -e {e_value} -v 0
+            {HHBLITS_UR30} -i {in_fasta} -oa3m {a3m_file}.tmp -e {e_value} -v 0
             """
             print(cmd)
             subprocess.run(cmd, shell=True, check=True)
+            os.replace(f"{a3m_file}.tmp", a3m_file)
         else:
             print(f"Found {a3m_file}, skipping HHblits against UniRef30 with E-value cutoff {e_value}.")
 
+        if not filter_only and pipeline.get_filter(task_element.step) and not os.path.exists(a3m_file_id90cov75):
+            hand_off_filter(task_element)
+            return
+
+        if get_filter_engine() == 'native':
+            # 一次读取同时写出两种覆盖度的过滤结果，下面的 hhfilter 步骤发现文件已存在后跳过
+            run_filters(a3m_file, [(a3m_file_id90cov75, 90, 75), (a3m_file_id90cov50, 90, 50)], cpu)
 
         # <<< Run hhfilter with 90% identity and 75% coverage >>>
-        a3m_file_id90cov75 = os.path.join(tmp_dir, f"t000_.{e_value}.id90cov75.a3m")
         if not os.path.exists(a3m_file_id90cov75):
             print(f"Running hhfilter on {final_msa} with E-value cutoff {e_value}, 90% identity, and 75% coverage")
             cmd = f"""
@@ -65,10 +82,12 @@ def run_hhblits_uniref(out_dir, in_fasta, cpu, mem, db_ur30, e_value, log_file,
             print(f"Found {a3m_file_id90cov75}, skipping HHfilter with 90% identity and 75% coverage.")
             
         # <<< Check the number of sequences in the filtered a3m file with 90% identity and 75% coverage >>>
-        n75 = int(subprocess.getoutput(f"grep -c '^>' {a3m_file_id90cov75}"))
-        # copy the filtered a3m file to the output directory if the number of sequences is greater than the threshold
-        if n75 > 2000 and not os.path.exists(final_msa):
-            os.system(f"cp {a3m_file_id90cov75} {final_msa}")
+        n75 = count_sequences(a3m_file_id90cov75)
+        # promote the filtered a3m file to the output directory if the number of sequences is greater than the threshold
+        if n75 > 2000:
+            # 并行的其他分支可能已提交结果，只有第一个提交的分支写出 final_msa
+            task_element.params["committed"] = commit(a3m_file_id90cov75, final_msa)
+            task_element.msa_stats = get_a3m_stats(final_msa)
             print(f"Found {n75} sequences in {a3m_file_id90cov75}, finishing the HHblits process.")
             terminate = True
             task_complete(task_element, terminate)
@@ -76,7 +95,6 @@ def run_hhblits_uniref(out_dir, in_fasta, cpu, mem, db_ur30, e_value, log_file,
 
 
         # <<< Run hhfilter with 90% identity and 50% coverage >>>
-        a3m_file_id90cov50 = os.path.join(tmp_dir, f"t000_.{e_value}.id90cov50.a3m")
         if not os.path.exists(a3m_file_id90cov50):
             print(f"Running hhfilter on {final_msa} with E-value cutoff {e_value}, 90% identity, and 50% coverage")
             cmd = f"""
@@ -88,29 +106,43 @@ def run_hhblits_uniref(out_dir, in_fasta, cpu, mem, db_ur30, e_value, log_file,
             print(f"Found {a3m_file_id90cov50}, skipping HHfilter with 90% identity and 50% coverage.")
 
         # <<< Check the number of sequences in the filtered a3m file with 90% identity and 50% coverage >>>
-        n50 = int(subprocess.getoutput(f"grep -c '^>' {a3m_file_id90cov50}"))
-        # copy the filtered a3m file to the output directory if the number of sequences is greater than the threshold
-        if n50 > 4000 and not os.path.exists(final_msa):
-            os.system(f"cp {a3m_file_id90cov50} {final_msa}")
+        n50 = count_sequences(a3m_file_id90cov50)
+        # promote the filtered a3m file to the output directory if the number of sequences is greater than the threshold
+        if n50 > 4000:
+            task_element.params["committed"] = commit(a3m_file_id90cov50, final_msa)
+            task_element.msa_stats = get_a3m_stats(final_msa)
             print(f"Found {n50} sequences in {a3m_file_id90cov50}, breaking the loop.")
             terminate = True
             task_complete(task_element, terminate)
             return
         
 
-        # 没有得到足够数量的msa，继续下一步hhblits操作
+        # 运行期间并行的推测分支已提交结果
+        if os.path.exists(final_msa):
+            print(f"Found final result file: {final_msa} committed by another branch, finishing the HHblits process.")
+            task_element.msa_stats = get_a3m_stats(final_msa)
+            terminate = True
+            task_complete(task_element, terminate)
+            return
+
+        # 没有得到足够数量的msa，沿流程图的条件边继续下一步hhblits操作
+        next_rung = get_next_rung(task_element.step)
+        if next_rung is None:
+            # 阶梯已经到底，使用当前结果作为最终 MSA，推测分支不提交不足阈值的结果
+            if not task_element.params.get('speculative'):
+                task_element.params["committed"] = commit(a3m_file_id90cov50, final_msa)
+                task_element.msa_stats = get_a3m_stats(final_msa)
+                print(f"No further rung after {task_element.step}, using {a3m_file_id90cov50} with {n50} sequences as the final MSA.")
+            terminate = True
+            task_complete(task_element, terminate)
+            return
+
+        task_element.msa_stats = get_a3m_stats(a3m_file_id90cov50)
         params = task_element.params
         # 修改fasta_file参数为上一步生成的a3m文件
         params["fasta_file"] = a3m_file_id90cov50
-        # 检测下一个e_value
-        next_e_value = e_value_list[e_value_list.index(e_value) + 1]
-
-        # 根据e_value的值修改下一步任务类型
-        if next_e_value == e_value: # 如果下一个e_value和当前e_value相同, 则进行hhblits_bfd操作
-            task_element.step = "hhblits_bfd"
-        else:
-            params["e_value"] = next_e_value
-            task_element.step = f"hhblits_uniref_{e_value_list.index(e_value) + 1}"
+        # 修改下一步任务类型和 e_value
+        task_element.step, params["e_value"] = next_rung
 
         task_element.params = params
         task_complete(task_element, terminate)
@@ -119,6 +151,7 @@ def run_hhblits_uniref(out_dir, in_fasta, cpu, mem, db_ur30, e_value, log_file,
 
     else:
         print(f"Found final result file: {final_msa}, skipping HHblits process.")
+        task_element.msa_stats = get_a3m_stats(final_msa)
         terminate = True
         task_complete(task_element, terminate)
         return
\ No newline at end of file
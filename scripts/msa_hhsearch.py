@@ -2,16 +2,25 @@ import os
 import subprocess
 
 from queue_system.queue_finished import queue_finished
+from scripts.result_cache import result_cache, template_cache, get_file_hash, HHSEARCH_PARAMS
 
 
 def task_complete(task_element):
     print(f'{task_element.step} step of {task_element.params["job_name"]} finished')
 
-    # 将任务加入finished队列等待资源回收
-    queue_finished.add_task(task_element)
-
     print(f'all steps of {task_element.params["job_name"]} finished')
 
+    # 将完整结果存入缓存，供其他作业中相同的序列使用
+    result_cache.store(task_element.params.get('cache_key'), task_element.params['job_output_path'])
+
+    # 相同序列的等待者直接共享结果
+    for waiter in task_element.params.get('waiters', []):
+        result_cache.link_results(task_element.params['job_output_path'], waiter['job_output_path'])
+
+    # 步骤完成，上报调度器回收资源，流程图中没有依赖 hhsearch 的步骤
+    task_element.step = None
+    queue_finished.add_task(task_element)
+
 
 def run_hhsearch(out_dir, cpu, mem, db_pdb70, log_file, task_element):
     out_prefix = os.path.join(out_dir, "t000_")
@@ -20,16 +29,26 @@ def run_hhsearch(out_dir, cpu, mem, db_pdb70, log_file, task_element):
     if os.path.exists(final_msa):
         if os.path.exists(f"{out_prefix}.hhr") and os.path.exists(f"{out_prefix}.atab"):
             print(f"Found {out_prefix}.hhr and {out_prefix}.atab, skipping HHsearch.")
+            task_complete(task_element)
             return
         
+        # 相同的 ss2 和 MSA 在同一版本的 PDB70 上已搜索过时直接使用缓存的结果
+        template_key = template_cache.get_input_key(get_file_hash(f"{out_prefix}.ss2", final_msa), db_pdb70, HHSEARCH_PARAMS)
+        if template_cache.lookup(template_key, out_dir):
+            task_complete(task_element)
+            return
+
         print("Running hhsearch")
         HH = f"hhsearch -b 50 -B 500 -z 50 -Z 500 -mact 0.05 -cpu {cpu} -maxmem {mem} -aliw 100000 -e 100 -p 5.0 -d {db_pdb70}"
+        # 只剩下其中一个的旧结果可能与模板缓存共享只读的 inode，先删除再写出
         cmd = f"""
+        rm -f {out_prefix}.hhr {out_prefix}.atab
         cat {out_prefix}.ss2 {out_prefix}.msa0.a3m > {out_prefix}.msa0.ss2.a3m
         {HH} -i {out_prefix}.msa0.ss2.a3m -o {out_prefix}.hhr -atab {out_prefix}.atab -v 0
         """
         print(cmd)
         subprocess.run(cmd, shell=True, check=True)
+        template_cache.store(template_key, out_dir)
 
     else:
         print(f"Missing {final_msa}, stopping HHsearch.")
@@ -2,30 +2,33 @@ import os
 import subprocess
 
 from queue_system.queue_finished import queue_finished
-from queue_system.queue_ready import queue_ready
-from scripts.utilities import get_job_mem_num, get_job_core_num
+from scripts.utilities import get_fasta_seq_len
+
+
+def use_trimmed_query(task_element):
+    # signalp6 去除信号肽后的序列，由流程图作为之后开始的步骤的查询序列
+    params = task_element.params
+    trim_fasta = os.path.join(params['job_output_path'], "signalp", "processed_entries.fasta")
+    if not os.path.exists(trim_fasta) or os.path.getsize(trim_fasta) == 0:
+        return
+    trimmed_len = get_fasta_seq_len(trim_fasta)
+    if trimmed_len == 0 or trimmed_len >= task_element.len:
+        return
+    params['trimmed_fasta'] = trim_fasta
+    params['trimmed_len'] = trimmed_len
+    print(f'{params["job_name"]} 去除信号肽后的序列长度: {task_element.len} -> {trimmed_len}')
 
 
 def task_complete(task_element):
     print(f'{task_element.step} step of {task_element.params["job_name"]} finished')
+    use_trimmed_query(task_element)
 
-    # 将任务加入finished队列等待资源回收
-    queue_finished.add_task(task_element)
+    # 步骤完成，后续步骤由调度器按流程图分派
+    task_element.step = None
+    print(f'任务{task_element}参数修改完毕，上报调度器回收资源')
 
-    # 修改参数为下一步 hhblits_uniref_1 的相关参数
-    # 修改任务类型
-    task_element.step = "hhblits_uniref_1"
-    # 获取任务所需的内存和核心数
-    task_element.mem = get_job_mem_num(task_element)
-    task_element.core = get_job_core_num(task_element)
-    params = task_element.params
-    # 修改任务参数
-    params["e_value"] = 1e-10
-    task_element.params = params
-    print(f'任务{task_element}参数修改完毕，加入ready队列等待资源分配')
-    
-    # 将任务加入ready队列等待资源分配
-    queue_ready.add_task(task_element)
+    # 上报调度器，由调度器回收资源、计算下一步所需资源并加入ready队列
+    queue_finished.add_task(task_element)
 
 
 def run_signalp6(out_dir, in_fasta, log_file, task_element):
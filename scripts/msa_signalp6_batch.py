@@ -0,0 +1,136 @@
+import os
+import shutil
+import subprocess
+
+from queue_system.task_element import TaskElement
+from queue_system.queue_finished import queue_finished
+from scripts.msa_signalp6 import task_complete
+
+
+# signalp6 的输出中按序列分行的文件，以 # 开头的行为表头
+SIGNALP_OUTPUT_FILES = ("prediction_results.txt", "output.gff3", "region_output.gff3")
+
+
+def is_batchable(task_element):
+    """尚未得到 signalp6 结果的任务可以合并成批运行"""
+    params = task_element.params
+    if params.get('batch_tasks') or params.get('no_batch'):
+        return False
+    return not os.path.exists(os.path.join(params['job_output_path'], "signalp", "prediction_results.txt"))
+
+
+def get_batch_mem(members, core):
+    """一个 signalp6 进程只加载一次模型并按固定的批大小推理，内存按成员中最大的预分配计算"""
+    return max(task_element.mem for task_element in members)
+
+
+def make_batch_task(members, output_path):
+    """将多个 signalp6 任务合并为一个批量任务，成员任务保存在参数 batch_tasks 中"""
+    first = members[0]
+    batch_task = TaskElement(first.step, max(task_element.len for task_element in members), {})
+    batch_dir = os.path.join(output_path, "batches", batch_task.id)
+    batch_task.params = {
+        "job_name": f"batch_{batch_task.id}",
+        "job_output_path": batch_dir,
+        "fasta_file": os.path.join(batch_dir, "queries.fasta"),
+        "batch_tasks": members,
+    }
+    batch_task.core = first.core
+    batch_task.mem = get_batch_mem(members, first.core)
+    print(f"合并 {len(members)} 个 {first.step} 任务为批量任务 {batch_task.id}: {[task_element.id for task_element in members]}")
+    return batch_task
+
+
+def write_query_fasta(members, query_fasta):
+    """将每个成员的查询序列写入同一个 fasta，序列名为任务 id"""
+    with open(query_fasta, 'w') as out_file:
+        for task_element in members:
+            with open(task_element.params['fasta_file'], 'r') as file:
+                sequence = ''.join(line.strip() for line in file if not line.startswith('>'))
+            out_file.write(f">{task_element.id}\n{sequence}\n")
+
+
+def get_query_name(task_element):
+    with open(task_element.params['fasta_file'], 'r') as file:
+        return next((line[1:].split()[0] for line in file if line.startswith('>') and line[1:].split()), task_element.id)
+
+
+def split_processed_entries(batch_output_dir, members):
+    """按序列名拆分去除信号肽后的序列，没有对应记录的成员不写出，后续步骤使用原序列"""
+    batch_file = os.path.join(batch_output_dir, "processed_entries.fasta")
+    if not os.path.exists(batch_file):
+        return
+    records, name = {}, None
+    with open(batch_file, 'r') as file:
+        for line in file:
+            if line.startswith('>'):
+                name = line[1:].split()[0] if line[1:].split() else None
+                records[name] = []
+            elif name is not None:
+                records[name].append(line.strip())
+
+    for task_element in members:
+        sequence = ''.join(records.get(task_element.id, []))
+        if not sequence:
+            continue
+        out_dir = os.path.join(task_element.params['job_output_path'], "signalp")
+        os.makedirs(out_dir, exist_ok=True)
+        tmp_file = os.path.join(out_dir, "processed_entries.fasta.tmp")
+        with open(tmp_file, 'w') as file:
+            file.write(f">{get_query_name(task_element)}\n{sequence}\n")
+        os.replace(tmp_file, os.path.join(out_dir, "processed_entries.fasta"))
+
+
+def split_signalp_output(batch_output_dir, members):
+    """按序列名将批量输出的每个文件拆分到各成员单独运行时的 signalp 目录，表头行写入每个成员的文件"""
+    split_processed_entries(batch_output_dir, members)
+    for name in SIGNALP_OUTPUT_FILES:
+        batch_file = os.path.join(batch_output_dir, name)
+        if not os.path.exists(batch_file):
+            continue
+        header, rows = [], {}
+        with open(batch_file, 'r') as file:
+            for line in file:
+                if line.startswith('#'):
+                    header.append(line)
+                elif line.strip():
+                    rows.setdefault(line.split('\t', 1)[0].strip(), []).append(line)
+
+        for task_element in members:
+            out_dir = os.path.join(task_element.params['job_output_path'], "signalp")
+            os.makedirs(out_dir, exist_ok=True)
+            # 序列名换回成员查询序列原来的名称
+            query_name = get_query_name(task_element)
+            tmp_file = os.path.join(out_dir, f"{name}.tmp")
+            with open(tmp_file, 'w') as file:
+                file.writelines(header)
+                for line in rows.get(task_element.id, []):
+                    file.write(query_name + line[len(task_element.id):])
+            os.replace(tmp_file, os.path.join(out_dir, name))
+
+
+def run_signalp6_batch(log_file, task_element):
+    """一次 signalp6 命令行运行预测批量任务的所有查询，模型在这次运行中只加载一次，不在批次之间常驻，再将结果拆分给各成员并分别上报"""
+    params = task_element.params
+    members = params['batch_tasks']
+    batch_dir = params['job_output_path']
+    os.makedirs(batch_dir, exist_ok=True)
+
+    query_fasta = params['fasta_file']
+    write_query_fasta(members, query_fasta)
+    batch_output_dir = os.path.join(batch_dir, "signalp")
+    cmd = f"""
+    signalp6 --fastafile {query_fasta} --organism other --output_dir {batch_output_dir} --format none --mode slow
+    """
+    print(cmd)
+    subprocess.run(cmd, shell=True, check=True)
+    split_signalp_output(batch_output_dir, members)
+
+    # 成员的结果已写出，与单独运行时相同地上报完成
+    for member in members:
+        task_complete(member)
+
+    shutil.rmtree(batch_dir, ignore_errors=True)
+    # 所有成员已分别上报，批量任务本身没有下一步骤
+    task_element.step = None
+    queue_finished.add_task(task_element)
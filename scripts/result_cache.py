@@ -0,0 +1,205 @@
+import os
+import errno
+import shutil
+import hashlib
+
+from queue_system.config import global_config
+from queue_system.pipeline import pipeline
+
+
+# 缓存的流程结果文件，均位于任务输出目录下
+RESULT_FILES = ["t000_.msa0.a3m", "t000_.ss2", "t000_.hhr", "t000_.atab"]
+# 模板搜索缓存的结果文件
+TEMPLATE_FILES = ["t000_.hhr", "t000_.atab"]
+
+# 代码中固定的影响流程结果的参数，修改 hhfilter 阈值或 hhsearch 参数时需同步修改，使旧缓存失效
+FILTER_PARAMS = "id90cov75>2000,id90cov50>4000"
+HHSEARCH_PARAMS = "b50B500z50Z500mact0.05aliw100000e100p5.0"
+# 流程图节点中影响结果的键
+PIPELINE_KEYS = ("run", "e_value", "on_insufficient", "filter", "after")
+
+
+def searches_trimmed_query():
+    """hhblits 阶梯在 signalp6 之后开始时搜索去除信号肽的序列，最终 MSA 与搜索完整序列时不同"""
+    reached = [root for root in pipeline.successors if pipeline.get_runner(root) == 'signalp6']
+    for root in reached:
+        reached.extend(successor for successor in pipeline.successors[root] if successor not in reached)
+    return any(pipeline.get_runner(root).startswith('hhblits') for root in reached)
+
+
+def get_pipeline_params():
+    """由配置文件中的流程图和过滤方式生成缓存键中的流程参数，修改流程图后旧缓存自动失效"""
+    if not pipeline.loaded:
+        pipeline.load()
+    args = global_config.get_args()
+    nodes = ';'.join(
+        f"{step}:" + ','.join(f"{key}={pipeline.nodes[step].get(key)}" for key in PIPELINE_KEYS)
+        for step in sorted(pipeline.nodes)
+    )
+    # 推测分支以较早一级的 MSA 为输入搜索，提交的最终 MSA 可能与串行阶梯不同
+    return (f"{nodes}|hhfilter={FILTER_PARAMS};engine={args.get('msa_filter_engine', 'hhfilter')}"
+            f"|hhsearch={HHSEARCH_PARAMS}|speculative_ladder={args.get('speculative_ladder', False)}"
+            f"|trimmed_query={searches_trimmed_query()}")
+
+
+def read_fasta_sequence(fasta_file):
+    """读取 fasta 文件中的序列并规范化：去除空白和末尾终止符，转为大写"""
+    with open(fasta_file, 'r') as file:
+        sequence = ''.join(line.strip() for line in file if not line.startswith('>'))
+    return ''.join(sequence.split()).upper().rstrip('*')
+
+
+def get_database_version(database):
+    """数据库版本由数据库名称和索引文件修改时间确定，数据库更新后缓存自动失效"""
+    if not database:
+        return ""
+    index_file = f"{database}_a3m.ffindex"
+    mtime = int(os.path.getmtime(index_file)) if os.path.exists(index_file) else 0
+    return f"{os.path.basename(database)}@{mtime}"
+
+
+def link_or_copy(src, dst):
+    """优先使用硬链接，跨文件系统时退回到复制"""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copyfile(src, dst)
+
+
+def get_file_hash(*files):
+    """按顺序计算多个文件内容的哈希，缺少的文件按空文件计算"""
+    digest = hashlib.sha256()
+    for path in files:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """按内容哈希、数据库版本和流程参数索引的结果缓存，name 对应配置中的 {name}_path 和 {name}_size
+    result_cache 以序列为键，不同作业中相同的蛋白序列共享 MSA 和模板搜索结果；template_cache 以 hhsearch 的输入为键，共享模板搜索结果"""
+
+    def __init__(self, name, files):
+        self.name = name
+        self.files = files
+        self.loaded = False
+        self.path = None
+        self.max_size = 0
+        self.db_versions = None
+        self.pipeline_params = None
+
+    def load(self):
+        args = global_config.get_args()
+        self.path = args.get(f'{self.name}_path')
+        self.max_size = args.get(f'{self.name}_size', 100) * 1024 ** 3
+        self.pipeline_params = get_pipeline_params()
+        self.db_versions = ';'.join(get_database_version(args.get(key)) for key in ('db_uniref_path', 'db_bfd_path', 'db_pdb_path'))
+        self.loaded = True
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+
+    def enabled(self):
+        if not self.loaded:
+            self.load()
+        return bool(self.path)
+
+    def get_key(self, fasta_file):
+        """计算缓存键，未启用缓存时同样用于合并同时提交的相同序列"""
+        if not self.loaded:
+            self.load()
+        sequence = read_fasta_sequence(fasta_file)
+        return hashlib.sha256(f"{sequence}|{self.db_versions}|{self.pipeline_params}".encode()).hexdigest()
+
+    def get_input_key(self, input_hash, database, params):
+        """由输入文件的哈希、所搜索数据库的版本和影响结果的参数计算缓存键"""
+        return hashlib.sha256(f"{input_hash}|{get_database_version(database)}|{params}".encode()).hexdigest()
+
+    def get_entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def lookup(self, key, out_dir):
+        """命中时将缓存结果以硬链接形式放入输出目录并返回 True，放入的文件与缓存条目一样是只读的"""
+        if not key or not self.enabled():
+            return False
+        entry = self.get_entry(key)
+        if not all(os.path.exists(os.path.join(entry, name)) for name in self.files):
+            return False
+        os.makedirs(out_dir, exist_ok=True)
+        for name in self.files:
+            link_or_copy(os.path.join(entry, name), os.path.join(out_dir, name))
+        # 以目录修改时间记录最近使用时间，用于 LRU 淘汰
+        os.utime(entry)
+        print(f"{self.name} 命中 {key[:12]}，结果已放入 {out_dir}")
+        return True
+
+    def link_results(self, src_dir, dst_dir):
+        """将流程结果以硬链接形式放入另一个输出目录，缺少的文件跳过"""
+        os.makedirs(dst_dir, exist_ok=True)
+        for name in self.files:
+            src = os.path.join(src_dir, name)
+            if os.path.exists(src):
+                link_or_copy(src, os.path.join(dst_dir, name))
+        print(f"结果已从 {src_dir} 放入 {dst_dir}")
+
+    def store(self, key, out_dir):
+        """流程完成后将结果存入缓存，条目先写入临时目录再原子地改名"""
+        if not key or not self.enabled():
+            return
+        if not all(os.path.exists(os.path.join(out_dir, name)) for name in self.files):
+            return
+        entry = self.get_entry(key)
+        if os.path.exists(entry):
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp_entry = f"{entry}.tmp.{os.getpid()}"
+        os.makedirs(tmp_entry, exist_ok=True)
+        for name in self.files:
+            cached_file = os.path.join(tmp_entry, name)
+            link_or_copy(os.path.join(out_dir, name), cached_file)
+            # 缓存条目与各任务的输出共享 inode，设为只读后原地改写输出的程序会报错，而不是同时改坏缓存和其他任务的结果
+            os.chmod(cached_file, 0o444)
+        try:
+            os.rename(tmp_entry, entry)
+            print(f"结果已存入 {self.name} {key[:12]}")
+        except OSError:
+            # 其他进程已存入相同结果
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """缓存总大小超过上限时按最近使用时间淘汰最旧的条目"""
+        entries = []
+        total_size = 0
+        for prefix in os.listdir(self.path):
+            prefix_dir = os.path.join(self.path, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry = os.path.join(prefix_dir, key)
+                if '.tmp.' in key:
+                    continue
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                    entries.append((os.path.getmtime(entry), size, entry))
+                except OSError:
+                    continue
+                total_size += size
+
+        entries.sort()
+        while entries and total_size > self.max_size:
+            _, size, entry = entries.pop(0)
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+            print(f"{self.name} 超过 {self.max_size / 1024 ** 3:.0f}GB，淘汰 {os.path.basename(entry)[:12]}")
+
+
+# 单例实例
+result_cache = ResultCache('result_cache', RESULT_FILES)
+template_cache = ResultCache('template_cache', TEMPLATE_FILES)
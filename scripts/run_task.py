@@ -5,64 +5,105 @@ from scripts.msa_hhblits_uniref import run_hhblits_uniref
 from scripts.msa_hhsearch import run_hhsearch
 from scripts.msa_psipred import run_psipred
 from scripts.msa_signalp6 import run_signalp6
+from scripts.msa_hhblits_batch import run_hhblits_batch
+from scripts.msa_signalp6_batch import run_signalp6_batch
+from scripts.msa_hhblits_filter import run_hhblits_filter
 from queue_system.config import global_config
+from queue_system.cgroup import cgroup_manager
+from queue_system.queue_finished import queue_finished
+from queue_system.pipeline import pipeline
+
+def run_in_cgroup(cgroup_path, writer, target_function, function_args):
+    # 使用自己的完成通道上报
+    queue_finished.attach(writer)
+    # 子进程先加入任务自己的 cgroup，之后启动的 hhblits 等程序都会在其中运行
+    if cgroup_path:
+        cgroup_manager.attach(cgroup_path)
+    task_element = function_args[-1]
+    # 绑定到调度器分配的核，之后启动的程序继承该亲和性
+    if task_element.cpus:
+        os.sched_setaffinity(0, task_element.cpus)
+    queue_finished.report('started', task_element)
+    try:
+        target_function(*function_args)
+    except BaseException:
+        # 上报失败后再抛出，使子进程以非零状态退出
+        queue_finished.report('failed', task_element)
+        raise
 
-log_file_map = {
-    'hhsearch': 'hhsearch.log',
-    'psipred': 'psipred.log',
-    'signalp6': 'signalp6.log',
-    'hhblits_bfd': 'hhblits_bfd.log',
-    'hhblits_uniref_1': 'hhblits_uniref_1.log',
-    'hhblits_uniref_2': 'hhblits_uniref_2.log',
-    'hhblits_uniref_3': 'hhblits_uniref_3.log',
-}
 
 def run_task(task_element):
     step = task_element.step
+    # 步骤的实现由流程图节点的 run 指定，同一实现可用于多个步骤
+    runner = pipeline.get_runner(step)
     params = task_element.params
-    cpu = task_element.core
+    # 绑定核时 -cpu 与实际分配的核数一致
+    cpu = len(task_element.cpus) if task_element.cpus else task_element.core
     out_dir = params['job_output_path']
     in_fasta = params['fasta_file']
     
     args = global_config.get_args()
     mem = args['max_job_mem_num']
     log_path = args['log_path']
-    log_file = os.path.join(log_path, log_file_map[step])
+    log_file = os.path.join(log_path, f"{step}.log")
+
+    if params.get('batch_tasks') and runner == 'signalp6':
+        # 多个查询合并为一次 signalp6 运行，模型只加载一次
+        target_function = run_signalp6_batch
+        function_args = (log_file, task_element)
+
+    elif params.get('batch_tasks'):
+        # 多个查询合并为一次 hhblits_omp 运行
+        db = args['db_bfd_path'] if runner == 'hhblits_bfd' else args['db_uniref_path']
+        target_function = run_hhblits_batch
+        function_args = (cpu, mem, db, log_file, task_element)
 
-    if step == 'signalp6':
+    elif runner == 'signalp6':
         # run_signalp6(out_dir, in_fasta, log_file)
         target_function = run_signalp6
         function_args = (out_dir, in_fasta, log_file, task_element)
 
-    elif step == 'hhblits_uniref_1' or step == 'hhblits_uniref_2' or step == 'hhblits_uniref_3':
+    elif runner == 'hhblits_uniref':
         db_ur30 = args['db_uniref_path']
         e_value = params['e_value']
         # run_hhblits_uniref(out_dir, in_fasta, cpu, mem, db_ur30, e_value, log_file)
         target_function = run_hhblits_uniref
         function_args = (out_dir, in_fasta, cpu, mem, db_ur30, e_value, log_file, task_element)
 
-    elif step == 'hhblits_bfd':
+    elif runner == 'hhblits_bfd':
         db_bfd = args['db_bfd_path']
         e_value = params['e_value']
         # run_hhblits_bfd(out_dir, in_fasta, cpu, mem, db_bfd, e_value, log_file)
         target_function = run_hhblits_bfd
         function_args = (out_dir, in_fasta, cpu, mem, db_bfd, e_value, log_file, task_element)
 
-    elif step == 'psipred':
+    elif runner == 'hhblits_filter':
+        # 搜索结束后单独调度的过滤和阈值判断
+        e_value = params['e_value']
+        target_function = run_hhblits_filter
+        function_args = (out_dir, in_fasta, cpu, e_value, log_file, task_element)
+
+    elif runner == 'psipred':
         pipe_dir = args['rfaa_pipe_path']
         # run_psipred(out_dir, pipe_dir, log_file)
         target_function = run_psipred
         function_args = (out_dir, pipe_dir, log_file, task_element)
 
-    elif step == 'hhsearch':
-        db_pdb70 = args['db_pdb70_path']
+    elif runner == 'hhsearch':
+        db_pdb70 = args['db_pdb_path']
         # run_hhsearch(out_dir, cpu, mem, db_pdb70, log_file)
         target_function = run_hhsearch
         function_args = (out_dir, cpu, mem, db_pdb70, log_file, task_element)
 
-    p = Process(target=target_function, args=function_args) # 创建进程
-    task_element.pid = p.pid # 记录进程ID
+    else:
+        raise ValueError(f"Invalid runner of step {step}: {runner}")
+
+    reader, writer = queue_finished.open_channel()
+    p = Process(target=run_in_cgroup, args=(task_element.cgroup, writer, target_function, function_args)) # 创建进程
     p.start() # 启动进程
+    queue_finished.add_channel(p.pid, reader, writer)
+    task_element.pid = p.pid # 记录进程ID, 进程启动后才有 pid
     print(f"Running task: {task_element}, PID: {task_element.pid}")
 
-    return
\ No newline at end of file
+    # 返回进程对象，调度器通过其 sentinel 感知子进程退出
+    return p
\ No newline at end of file
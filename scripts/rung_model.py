@@ -0,0 +1,137 @@
+import os
+import json
+import math
+
+from queue_system.config import global_config
+
+
+HYDROPHOBIC = set('AILMFVW')
+
+
+def get_sequence_features(fasta_file):
+    """由查询序列计算特征: 长度的对数、组成熵(按 log 20 归一化)和疏水残基比例
+    fasta_file 可以是 a3m，只读取第一条序列"""
+    sequence = []
+    with open(fasta_file, 'r') as file:
+        for line in file:
+            if line.startswith('>'):
+                if sequence:
+                    break
+                continue
+            sequence.append(line.strip())
+    sequence = ''.join(sequence).upper()
+    length = len(sequence)
+    if length == 0:
+        return [0.0, 0.0, 0.0]
+    counts = {}
+    for residue in sequence:
+        counts[residue] = counts.get(residue, 0) + 1
+    entropy = -sum(count / length * math.log(count / length) for count in counts.values())
+    hydrophobic = sum(count for residue, count in counts.items() if residue in HYDROPHOBIC)
+    return [math.log(length), entropy / math.log(20), hydrophobic / length]
+
+
+def get_signalp_result(out_dir):
+    """读取 signalp6 的预测结果，预测有信号肽时返回 1.0，否则或没有结果时返回 0.0"""
+    result_file = os.path.join(out_dir, "signalp", "prediction_results.txt")
+    if not os.path.exists(result_file):
+        return 0.0
+    with open(result_file, 'r') as file:
+        for line in file:
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            return 0.0 if len(fields) < 2 or fields[1].strip() == 'OTHER' else 1.0
+    return 0.0
+
+
+class RungModel:
+    """记录每个蛋白最终在 hhblits 阶梯哪一级得到 MSA，用近邻预测新任务可以直接从哪一级开始"""
+
+    def __init__(self):
+        self.loaded = False
+        self.path = None
+        self.min_samples = 50
+        self.neighbors = 10
+        self.confidence = 0.9
+        self.max_samples = 5000
+        self.samples = []  # [{"features": [...], "first_nseq": 首级序列条数或 None, "rung": 得到 MSA 的级别}, ...]
+        self.dirty = False
+
+    def load(self):
+        """从配置文件读取模型参数，并加载上次运行保存的观测值"""
+        args = global_config.get_args()
+        self.path = args.get('rung_model_path')
+        self.min_samples = args.get('rung_model_min_samples', self.min_samples)
+        self.neighbors = args.get('rung_model_neighbors', self.neighbors)
+        self.confidence = args.get('rung_model_confidence', self.confidence)
+        self.loaded = True
+
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as file:
+                self.samples = json.load(file)
+            print(f"Loaded rung model from {self.path}")
+        except (OSError, ValueError) as e:
+            print(f"Error loading rung model {self.path}: {e}, running the full ladder")
+            self.samples = []
+
+    def save(self):
+        """原子地写回模型文件，供下次运行继续使用"""
+        if not self.dirty or not self.path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(self.samples, file)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def record(self, features, first_nseq, rung):
+        """记录一个蛋白的特征和最终得到 MSA 的级别"""
+        if not self.loaded:
+            self.load()
+        if not self.path or features is None or rung < 0:
+            return
+        self.samples.append({"features": features, "first_nseq": first_nseq, "rung": rung})
+        # 只保留最近的观测值，使模型跟随数据库版本的变化
+        if len(self.samples) > self.max_samples:
+            del self.samples[:len(self.samples) - self.max_samples]
+        self.dirty = True
+
+    def predict(self, features, first_nseq=None):
+        """返回可以直接开始的级别：至少 confidence 比例的近邻都没有在更早的级别得到 MSA，观测值不足时返回 0"""
+        if not self.loaded:
+            self.load()
+        # 已知首级序列条数时只与同样记录了首级序列条数的样本比较
+        samples = [sample for sample in self.samples if first_nseq is None or sample['first_nseq'] is not None]
+        if len(samples) < self.min_samples:
+            return 0
+
+        def vector(sample_features, nseq):
+            return sample_features + ([math.log1p(nseq)] if first_nseq is not None else [])
+
+        points = [vector(sample['features'], sample['first_nseq']) for sample in samples]
+        query = vector(features, first_nseq)
+        # 各特征按标准差归一化后计算欧氏距离
+        scales = []
+        for column in zip(*points):
+            mean = sum(column) / len(column)
+            scales.append(math.sqrt(sum((value - mean) ** 2 for value in column) / len(column)) or 1.0)
+        distances = sorted(
+            (sum(((a - b) / scale) ** 2 for a, b, scale in zip(point, query, scales)), sample['rung'])
+            for point, sample in zip(points, samples)
+        )
+        rungs = [rung for _, rung in distances[:self.neighbors]]
+
+        # 跳过的级别必须是绝大多数近邻都没有在其上得到 MSA 的级别
+        predicted = 0
+        for rung in range(1, max(rungs) + 1):
+            if sum(1 for value in rungs if value >= rung) >= self.confidence * len(rungs):
+                predicted = rung
+        return predicted
+
+
+# 单例实例
+rung_model = RungModel()
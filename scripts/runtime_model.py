@@ -0,0 +1,128 @@
+import os
+import csv
+import json
+import math
+
+from queue_system.config import global_config
+
+
+# 各步骤对应 make_msa_parallel_yhshao_time_statistic.py 输出的统计文件，同一 ID 的多个文件耗时相加
+step_to_stat_files = {
+    "signalp6": ["signalp6_stat.csv"],
+    "hhblits_uniref_1": ["hhblits_stat_uniref_1e-10.csv", "hhfilter_stat_75_uniref_1e-10.csv", "hhfilter_stat_50_uniref_1e-10.csv"],
+    "hhblits_uniref_2": ["hhblits_stat_uniref_1e-06.csv", "hhfilter_stat_75_uniref_1e-06.csv", "hhfilter_stat_50_uniref_1e-06.csv"],
+    "hhblits_uniref_3": ["hhblits_stat_uniref_0.001.csv", "hhfilter_stat_75_uniref_0.001.csv", "hhfilter_stat_50_uniref_0.001.csv"],
+    "hhblits_bfd": ["hhblits_stat_bfd.csv", "hhfilter_stat_bfd.csv"],
+    "psipred": ["psipred_stat.csv"],
+    "hhsearch": ["hhsearch_stat.csv"],
+}
+
+
+# runtime_prior 中没有列出的步骤每个残基的耗时(秒)
+DEFAULT_PRIOR = 1.0
+
+
+def read_stat_files(stat_dir, stat_files):
+    """读取统计文件，返回 [(序列长度, 耗时秒数), ...]"""
+    samples = {}
+    for stat_file in stat_files:
+        stat_path = os.path.join(stat_dir, stat_file)
+        if not os.path.exists(stat_path):
+            continue
+        with open(stat_path, 'r', newline='') as csvfile:
+            for row in csv.DictReader(csvfile):
+                try:
+                    seq_length = float(row['len'])
+                    real_time = float(row['real_time']) * 60  # 统计文件中为分钟
+                except (KeyError, TypeError, ValueError):
+                    continue
+                length, total_time = samples.get(row.get('ID'), (seq_length, 0.0))
+                samples[row.get('ID')] = (length, total_time + real_time)
+    return list(samples.values())
+
+
+class RuntimeModel:
+    """按步骤拟合 log(耗时) = a + b * log(序列长度)，用于预测任务运行时间"""
+
+    def __init__(self):
+        self.loaded = False
+        self.path = None
+        self.stats = {}  # step -> [n, sum_x, sum_y, sum_xx, sum_xy]
+        self.dirty = False
+
+    def load(self):
+        """加载上次保存的模型，没有记录的步骤用历史统计文件初始化"""
+        args = global_config.get_args()
+        self.path = args.get('runtime_model_path')
+        stat_dir = args.get('runtime_stat_path')
+        self.loaded = True
+
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as file:
+                    self.stats = json.load(file)
+                print(f"Loaded runtime model from {self.path}")
+            except (OSError, ValueError) as e:
+                print(f"Error loading runtime model {self.path}: {e}")
+                self.stats = {}
+
+        if stat_dir and os.path.isdir(stat_dir):
+            for step, stat_files in step_to_stat_files.items():
+                if step in self.stats:
+                    continue
+                samples = read_stat_files(stat_dir, stat_files)
+                for seq_length, real_time in samples:
+                    self.record(step, seq_length, real_time)
+                if samples:
+                    print(f"Seeded runtime model of {step} with {len(samples)} records from {stat_dir}")
+
+    def save(self):
+        """原子地写回模型文件"""
+        if not self.dirty or not self.path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(self.stats, file)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def record(self, step, seq_length, real_time):
+        """记录一次已完成任务的实际耗时(秒)"""
+        if not self.loaded:
+            self.load()
+        if seq_length <= 0 or real_time <= 0:
+            return
+        x = math.log(seq_length)
+        y = math.log(real_time)
+        stat = self.stats.setdefault(step, [0, 0.0, 0.0, 0.0, 0.0])
+        stat[0] += 1
+        stat[1] += x
+        stat[2] += y
+        stat[3] += x * x
+        stat[4] += x * y
+        self.dirty = True
+
+    def predict(self, step, seq_length):
+        """预测任务运行时间(秒)，没有观测值时按 runtime_prior 中该步骤每个残基的秒数估计
+        已训练和未训练的步骤都以秒为单位，可以在同一流程中相加比较"""
+        if not self.loaded:
+            self.load()
+        stat = self.stats.get(step)
+        if not stat or stat[0] == 0:
+            prior = (global_config.get_args().get('runtime_prior') or {}).get(step, DEFAULT_PRIOR)
+            return prior * max(seq_length, 1)
+
+        n, sum_x, sum_y, sum_xx, sum_xy = stat
+        x = math.log(max(seq_length, 1))
+        variance = n * sum_xx - sum_x * sum_x
+        if n < 2 or variance <= 1e-9:
+            # 观测值不足以拟合斜率，使用对数均值
+            return math.exp(sum_y / n)
+        b = (n * sum_xy - sum_x * sum_y) / variance
+        a = (sum_y - b * sum_x) / n
+        return math.exp(a + b * x)
+
+
+# 单例实例
+runtime_model = RuntimeModel()
@@ -1,4 +1,10 @@
+import os
+import math
+
 from queue_system.config import global_config
+from queue_system.pipeline import pipeline
+from scripts.memory_model import memory_model, get_len_bucket
+from scripts.a3m_filter import get_filter_engine
 
 
 def get_job_core_num(task_element):
@@ -6,9 +12,39 @@ def get_job_core_num(task_element):
     args = global_config.get_args()
     core_num = args['job_core_num'][step]
 
+    # hhfilter 是单线程的，native 方式的矩阵乘法可以使用多个核
+    if pipeline.get_runner(step) == 'hhblits_filter' and get_filter_engine() == 'native':
+        core_num = args.get('msa_filter_native_core', core_num)
+
+    # 使用 MSA 的步骤按最终 MSA 的统计查表
+    msa_resource = get_msa_resource(task_element)
+    if msa_resource is not None:
+        core_num = msa_resource[1].get('core', core_num)
+
     return core_num
 
 
+def get_msa_resource(task_element):
+    """按最终 MSA 的统计在 msa_resource_table 中查找步骤的资源行，返回 (行号, 行)，未配置该步骤或没有 MSA 统计时返回 None
+    依次检查各行，第一个所有 max_<统计量> 上限都大于对应统计量的行生效，没有命中时使用最后一行"""
+    table = (global_config.get_args().get('msa_resource_table') or {}).get(task_element.step)
+    stats = task_element.msa_stats
+    if not table or not stats:
+        return None
+    for index, row in enumerate(table):
+        if all(stats.get(key[len('max_'):], 0) < limit for key, limit in row.items() if key.startswith('max_')):
+            return index, row
+    return len(table) - 1, table[-1]
+
+
+def get_memory_key(task_element):
+    """内存模型中记录和估计的键，按 MSA 统计查表的步骤按表中的行分别统计"""
+    msa_resource = get_msa_resource(task_element)
+    if msa_resource is None:
+        return task_element.step
+    return f"{task_element.step}@msa{msa_resource[0]}"
+
+
 def get_fasta_seq_len(fasta_file):
     with open(fasta_file, 'r') as file:
         lines = file.readlines()
@@ -19,13 +55,8 @@ def get_fasta_seq_len(fasta_file):
 
 
 def get_mem_num_with_len(seq_length, mem_cost_list):
-    # 定义区间边界: [100, 200, 300, 400, 500, 600, 700, 800, 900, 1000, 2000, inf]
-    length_bounds = [100 * i for i in range(1, 11)] + [2000, float('inf')]
-    
-    # 根据序列长度找到对应区间的内存大小
-    for i, bound in enumerate(length_bounds):
-        if seq_length < bound:
-            return mem_cost_list[i]
+    # 根据序列长度找到对应区间的内存大小, 区间边界见 memory_model.LENGTH_BOUNDS
+    return mem_cost_list[get_len_bucket(seq_length)]
 
 
 def get_job_mem_num(task_element):
@@ -33,7 +64,85 @@ def get_job_mem_num(task_element):
     fasta_seq_len = task_element.len
     args = global_config.get_args()
 
+    # 过滤任务的内存与 a3m 大小成正比，与序列长度关系不大
+    if pipeline.get_runner(step) == 'hhblits_filter':
+        return get_filter_mem_num(task_element)
+
     mem_cost_list = args['job_mem_num'][step]
     mem_cost = get_mem_num_with_len(fasta_seq_len, mem_cost_list)
+    # psipred、hhsearch 等步骤的开销主要取决于 MSA 的深度和宽度，有统计时按 MSA 查表
+    msa_resource = get_msa_resource(task_element)
+    if msa_resource is not None:
+        mem_cost = msa_resource[1].get('mem', mem_cost)
+
+    # 静态表作为冷启动先验，观测值足够后使用在线学习的内存模型
+    mem_cost = memory_model.estimate(get_memory_key(task_element), fasta_seq_len, mem_cost)
+
+    return mem_cost
+
+def get_intermediate_a3m(task_element):
+    """返回任务当前步骤 hhblits 搜索输出的 a3m 路径，重新运行时该文件存在则跳过搜索，其他步骤返回 None"""
+    runner = pipeline.get_runner(task_element.step)
+    params = task_element.params
+    # 过滤任务处理其搜索步骤输出的 a3m
+    if runner == 'hhblits_filter':
+        runner = pipeline.get_runner(params['search_step'])
+    tmp_dir = os.path.join(params['job_output_path'], "hhblits")
+    tag = get_a3m_tag(params)
+    if runner == 'hhblits_uniref':
+        return os.path.join(tmp_dir, f"t000_.{params['e_value']}{tag}.a3m")
+    if runner == 'hhblits_bfd':
+        return os.path.join(tmp_dir, f"t000_.{params['e_value']}{tag}.bfd.a3m")
+    return None
+
+
+def get_a3m_tag(params):
+    """推测分支的输入与主线这一级的输入不同，其搜索和过滤结果使用单独的文件名，主线只通过 final_msa 看到其提交的结果"""
+    return ".spec" if params.get('speculative') else ""
+
+
+def get_filter_mem_num(task_element):
+    """按待过滤的 a3m 大小估计过滤任务的内存(GB)，向上取整到 0.5GB"""
+    a3m_file = get_intermediate_a3m(task_element)
+    a3m_size = os.path.getsize(a3m_file) / 1024 ** 3 if a3m_file and os.path.exists(a3m_file) else 0
+    args = global_config.get_args()
+    # native 方式为每条已保留的序列的每个对齐列保存 84 字节的 one-hot 和残基掩码，a3m 中每个对齐列至少占 1 字节
+    if get_filter_engine() == 'native':
+        mem = a3m_size * args.get('msa_filter_native_mem_ratio', 90) + 0.5
+    else:
+        mem = a3m_size * args.get('filter_mem_ratio', 3) + 0.5
+    return math.ceil(mem * 2) / 2
+
+
+def get_step_database(task_element):
+    """返回任务当前步骤搜索的数据库路径，不搜索数据库的步骤返回 None"""
+    runner = pipeline.get_runner(task_element.step)
+    args = global_config.get_args()
+    if runner == 'hhblits_uniref':
+        return args.get('db_uniref_path')
+    if runner == 'hhblits_bfd':
+        return args.get('db_bfd_path')
+    if runner == 'hhsearch':
+        return args.get('db_pdb_path')
+    return None
+
+
+def get_ladder(step):
+    """返回 step 所在 hhblits 阶梯的 [(步骤, e_value), ...]，即流程图中由条件边 on_insufficient 连接的 hhblits 步骤"""
+    if not pipeline.has_step(step) or not pipeline.get_runner(step).startswith('hhblits'):
+        return []
+    return [(rung_step, pipeline.get_e_value(rung_step)) for rung_step in pipeline.get_chain(step)]
+
+
+def get_next_rung(step):
+    """返回阶梯中 step 的下一级 (步骤, e_value)，最后一级或不在阶梯中的步骤返回 None"""
+    if not get_ladder(step) or pipeline.get_next(step) is None:
+        return None
+    next_step = pipeline.get_next(step)
+    return next_step, pipeline.get_e_value(next_step)
+
 
-    return mem_cost
\ No newline at end of file
+def get_rung_index(step):
+    """返回步骤在阶梯中的位置，不在阶梯中的步骤返回 -1"""
+    steps = [rung_step for rung_step, _ in get_ladder(step)]
+    return steps.index(step) if step in steps else -1